@@ -0,0 +1,310 @@
+# core
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sys
+
+# 3rd party
+from argh import dispatch_command, arg
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+COLUMNS = ('majorLevel', 'increments', 'numberOfOrders', 'size', 'profitTarget')
+
+
+def load_bars(path):
+    """Read historical prices from a CSV file with a header row.
+
+    OHLC files need high, low and close columns (open is used for the
+    first grid if present). Trade files with just a price column are
+    read as bars whose high, low and close are that price.
+    """
+    with open(path) as f:
+        rows = list(csv.DictReader(f))
+    if not rows:
+        raise ValueError("{0} has no rows".format(path))
+
+    def column(name):
+        return np.array([float(row[name]) for row in rows])
+
+    fields = dict((name.lower(), name) for name in rows[0])
+    if 'price' in fields:
+        price = column(fields['price'])
+        return dict(open=price, high=price, low=price, close=price)
+
+    bars = dict(
+        (name, column(fields[name])) for name in ('high', 'low', 'close'))
+    bars['open'] = column(fields['open']) if 'open' in fields else bars['close']
+    return bars
+
+
+def combinations(**values):
+    """Every combination of the given parameter lists, as parallel arrays.
+
+    combinations(majorLevel=[1, 2], size=[30], ...) returns one array per
+    parameter in COLUMNS, with an element per combination.
+    """
+    rows = list(itertools.product(*[values[name] for name in COLUMNS]))
+    columns = zip(*rows)
+    params = dict(
+        (name, np.array(column, dtype=float))
+        for name, column in zip(COLUMNS, columns))
+    params['numberOfOrders'] = params['numberOfOrders'].astype(int)
+    return params
+
+
+def subset(params, rows):
+    return dict((name, column[rows]) for name, column in params.items())
+
+
+def ladders(price, direction, params, width):
+    """Grid rates for every combination, one row each, as grid.levels computes them.
+
+    Rows are padded with NaN out to width beyond each combination's
+    numberOfOrders.
+    """
+    first = price * (1 + direction * params['majorLevel'] / 100.0)
+    step = 1 + direction * params['increments'] / 100.0
+    depth = np.arange(width)
+    rates = first[:, None] * step[:, None] ** depth[None, :]
+    rates[depth[None, :] >= params['numberOfOrders'][:, None]] = np.nan
+    return rates
+
+
+def place_profit_sells(profit, rows, rates, filled, wanted):
+    """Put each row's filled rates into its free (NaN) profit slots.
+
+    The profit array is widened when a row has fewer free slots than
+    orders to place, so it is returned rather than updated in place.
+    """
+    free = np.isnan(profit[rows])
+    short = (wanted - free.sum(1)).max()
+    if short > 0:
+        profit = np.hstack([profit, np.full((len(profit), short), np.nan)])
+        free = np.isnan(profit[rows])
+
+    # Stable sorts bring free slots, and filled levels, to the front.
+    slots = np.argsort(~free, axis=1, kind='mergesort')
+    levels = np.argsort(~filled, axis=1, kind='mergesort')
+    i, j = np.nonzero(np.arange(filled.shape[1])[None, :] < wanted[:, None])
+    profit[rows[i], slots[i, j]] = rates[i, levels[i, j]]
+    return profit
+
+
+def simulate(bars, params, core=1000.0, btc=1.0):
+    """Run the TradePad grid logic over bars for every parameter combination.
+
+    Each combination starts with a sell grid above and a buy grid below
+    the first open, sized from `core` units of coin as grid_parameters
+    sizes them, and then on every bar, as poll does:
+
+    - buy levels at or above the low fill, and each places a profit-taking
+      sell profitTarget percent above its rate;
+    - sell levels and profit sells at or below the high fill;
+    - sell grid fills cancel the buy grid and rebuild it below the
+      deepest filled sell rate;
+    - an exhausted grid is rebuilt from the close.
+
+    Fills are found against the orders standing at the start of a bar, so
+    orders placed during a bar can only fill from the next one. Balances
+    are not checked before placing orders; combinations that would have
+    run out of coin or BTC are flagged as overdrawn.
+
+    The loop runs over bars; each step works on every combination at once.
+    Returns a dict of per-combination result arrays.
+    """
+    n_combos = len(params['majorLevel'])
+    width = int(params['numberOfOrders'].max())
+    everyone = np.ones(n_combos, dtype=bool)
+    order_size = params['size'] * core / 100.0 / params['numberOfOrders']
+    profit_ratio = 1 + params['profitTarget'] / 100.0
+    takes_profit = params['profitTarget'] > 0
+
+    start = bars['open'][0]
+    sells = ladders(start * everyone, 1, params, width)
+    buys = ladders(start * everyone, -1, params, width)
+    profit = np.full((n_combos, width), np.nan)
+
+    coin = np.full(n_combos, float(core))
+    cash = np.full(n_combos, float(btc))
+    buy_fills = np.zeros(n_combos, dtype=int)
+    sell_fills = np.zeros(n_combos, dtype=int)
+    overdrawn = np.zeros(n_combos, dtype=bool)
+
+    with np.errstate(invalid='ignore'):
+        for high, low, close in zip(bars['high'], bars['low'], bars['close']):
+            bought = buys >= low
+            sold = sells <= high
+            taken = profit <= high
+
+            n_bought = bought.sum(1)
+            n_sold = sold.sum(1) + taken.sum(1)
+            proceeds = (np.where(sold, sells, 0).sum(1)
+                        + np.where(taken, profit, 0).sum(1))
+            coin += (n_bought - n_sold) * order_size
+            cash += (proceeds - np.where(bought, buys, 0).sum(1)) * order_size
+            buy_fills += n_bought
+            sell_fills += n_sold
+            overdrawn |= (coin < 0) | (cash < 0)
+
+            # Profit-taking sells for this bar's buy fills go in free slots.
+            profit[taken] = np.nan
+            placing = np.nonzero(n_bought * takes_profit)[0]
+            if len(placing):
+                profit = place_profit_sells(
+                    profit, placing, buys[placing] * profit_ratio[placing, None],
+                    bought[placing], n_bought[placing])
+
+            elevate = sold.any(1)
+            deepest = np.where(sold, sells, -np.inf).max(1)
+            buys[bought] = np.nan
+            sells[sold] = np.nan
+            if elevate.any():
+                buys[elevate] = ladders(
+                    deepest[elevate], -1, subset(params, elevate), width)
+
+            for grid, direction in ((buys, -1), (sells, 1)):
+                exhausted = np.isnan(grid).all(1)
+                if exhausted.any():
+                    grid[exhausted] = ladders(
+                        close * everyone[exhausted], direction,
+                        subset(params, exhausted), width)
+
+    last = bars['close'][-1]
+    value = cash + coin * last
+    held = btc + core * last
+    return dict(
+        value=value,
+        excess=value - held,
+        coin=coin,
+        btc=cash,
+        buy_fills=buy_fills,
+        sell_fills=sell_fills,
+        overdrawn=overdrawn,
+    )
+
+
+def _simulate_chunk(task):
+    "Pool worker: simulate one pair's bars for one slice of the combinations."
+    path, params, core, btc = task
+    return simulate(load_bars(path), params, core, btc)
+
+
+def chunks(n_combos, n):
+    "Split range(n_combos) into at most n contiguous slices."
+    size = max(1, -(-n_combos // n))
+    return [slice(i, i + size) for i in range(0, n_combos, size)]
+
+
+def sweep(paths, params, core=1000.0, btc=1.0, processes=None):
+    """Simulate every combination on every pair's bars, using all cores.
+
+    Work is split by pair, and each pair's combinations are split further
+    when there are fewer pairs than processes. Returns {path: results}.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    n_combos = len(params['majorLevel'])
+    pieces = chunks(n_combos, max(1, processes // len(paths)))
+    tasks = [
+        (path, subset(params, piece), core, btc)
+        for path in paths
+        for piece in pieces
+    ]
+
+    if processes == 1:
+        parts = [_simulate_chunk(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            parts = pool.map(_simulate_chunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    results = dict()
+    for i, path in enumerate(paths):
+        mine = parts[i * len(pieces):(i + 1) * len(pieces)]
+        results[path] = dict(
+            (name, np.concatenate([part[name] for part in mine]))
+            for name in mine[0])
+    return results
+
+
+def floats(text):
+    return [float(v) for v in text.split(',')]
+
+
+def pair_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+@arg('paths', nargs='+', help="CSV price files, one per pair, named after it")
+@arg('--major-level', help="Comma-separated majorLevel values to try")
+@arg('--increments', help="Comma-separated increments values to try")
+@arg('--number-of-orders', help="Comma-separated numberOfOrders values to try")
+@arg('--size', help="Comma-separated size values to try")
+@arg('--profit-target', help="Comma-separated profitTarget values to try")
+@arg('--core', help="Initial core position of each pair's coin")
+@arg('--btc', help="Initial BTC per pair")
+@arg('--processes', help="Worker processes; all cores by default")
+@arg('--top', help="Best combinations listed per pair and overall")
+@arg('--output', help="JSON file every combination's results are written to")
+def main(paths, major_level='1', increments='1', number_of_orders='5',
+         size='30', profit_target='6', core=1000.0, btc=1.0, processes=None,
+         top=10, output=None):
+    """Backtest [sellgrid]/[buygrid] parameter combinations on price history.
+
+    The same majorLevel, increments, numberOfOrders and size apply to both
+    grids; profitTarget applies to the buy grid. Combinations are ranked
+    by their final value in BTC above simply holding the core position.
+    """
+    if np is None:
+        sys.exit("backtest needs numpy: pip install numpy")
+    from tabulate import tabulate
+
+    logging.disable(logging.DEBUG)
+    params = combinations(
+        majorLevel=floats(major_level), increments=floats(increments),
+        numberOfOrders=[int(v) for v in floats(number_of_orders)],
+        size=floats(size), profitTarget=floats(profit_target))
+    results = sweep(paths, params, core, btc, processes and int(processes))
+
+    def table(excess, extra):
+        rows = list()
+        for i in np.argsort(-excess)[:top]:
+            rows.append([params[name][i] for name in COLUMNS]
+                        + [excess[i]] + [column[i] for column in extra])
+        return tabulate(rows, headers=list(COLUMNS) + ['excess'] + [
+            'buys', 'sells', 'overdrawn'][:len(extra)])
+
+    for path in paths:
+        r = results[path]
+        print("\n{0}: {1} combinations".format(pair_name(path), len(r['excess'])))
+        print(table(r['excess'], [r['buy_fills'], r['sell_fills'], r['overdrawn']]))
+
+    if len(paths) > 1:
+        print("\nAll pairs")
+        print(table(sum(results[path]['excess'] for path in paths), []))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(dict(
+                params=dict((name, params[name].tolist()) for name in COLUMNS),
+                pairs=dict(
+                    (pair_name(path), dict(
+                        (name, column.tolist())
+                        for name, column in results[path].items()))
+                    for path in paths),
+            ), f)
+        print("Results written to {0}".format(output))
+
+
+if __name__ == '__main__':
+    dispatch_command(main)
@@ -0,0 +1,378 @@
+# core
+import ConfigParser
+import inspect
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+import timeit
+
+# 3rd party
+from argh import dispatch_commands, arg
+
+# local
+import exchange
+from grid import SellGrid
+from main import delta_by_percent, TradePad
+from mynumbers import F
+import simulator
+
+
+def midpoint(f, lowest_ask, highest_bid):
+    "The arithmetic TradePad.midpoint performs on a ticker."
+    return (f(lowest_ask) + f(highest_bid)) / 2.0
+
+
+def sell_levels(f, price, major_level, increments, number_of_orders):
+    "The grid arithmetic: successive delta_by_percent steps from a price."
+    rate = delta_by_percent(f(price), major_level)
+    levels = [rate]
+    for _ in range(number_of_orders - 1):
+        rate = delta_by_percent(rate, increments)
+        levels.append(rate)
+    return levels
+
+
+def sympy_F():
+    "The previous sympy-backed F(), or None when sympy is not installed."
+    try:
+        from sympy import N
+    except ImportError:
+        return None
+    return lambda n: N(n, 8)
+
+
+def _time(stmt, number):
+    best = min(timeit.repeat(stmt, number=number, repeat=3))
+    return best / number * 1e6
+
+
+@arg('--number', help="Calls per timing run")
+def numbers(number=2000):
+    "Time grid and midpoint arithmetic with F() against the sympy path."
+    implementations = [('fixed', F)]
+    sympy_f = sympy_F()
+    if sympy_f is None:
+        print("sympy not installed; timing the fixed-point F() only")
+    else:
+        implementations.append(('sympy', sympy_f))
+
+    for name, f in implementations:
+        mid = _time(lambda: midpoint(f, '0.00012345', '0.00012299'), number)
+        grid = _time(lambda: sell_levels(f, '0.00012345', 1, 1, 20), number)
+        print("{0:>6}: midpoint {1:8.2f} us   20-level grid {2:8.2f} us".format(
+            name, mid, grid))
+
+
+class RecordedBittrex(object):
+    "A Bittrex client that answers with canned responses."
+
+    def __init__(self, markets=250):
+        self.summaries = dict(success=True, message='', result=[
+            dict(MarketName='BTC-C{0}'.format(i), Bid=0.0001 + i * 1e-8,
+                 Ask=0.00011 + i * 1e-8, Volume=1000.0 + i)
+            for i in range(markets)
+        ])
+        self.balance = dict(success=True, message='', result=dict(
+            Currency='BTC', Balance=1.5, Available=1.0, Pending=0.0))
+        self.order = dict(success=True, message='', result=dict(
+            OrderUuid='x', Exchange='BTC-C0', Type='LIMIT_BUY',
+            Quantity=1.0, QuantityRemaining=1.0, Limit=0.0001, IsOpen=True))
+
+    def get_market_summaries(self):
+        return self.summaries
+
+    def get_balance(self, currency):
+        return self.balance
+
+    def get_balances(self):
+        return dict(success=True, message='', result=[self.balance['result']])
+
+    def get_order(self, uuid):
+        return self.order
+
+
+def _caller_name():
+    return inspect.stack()[1][3]
+
+
+@arg('--number', help="Calls per timing run")
+def verify(number=2000):
+    """Time BittrexFacade.verify against recorded responses.
+
+    Balances are served from the facade's snapshot without a verify, so
+    isOpen, which verifies every get_order response, is timed instead.
+    """
+    api = RecordedBittrex()
+    facade = exchange.BittrexFacade(api=api, payload_every=10)
+
+    raw = _time(lambda: facade.wrap(api.get_order('x')['result']), number)
+    rows = [
+        ('isOpen', _time(lambda: facade.isOpen('x'), number)),
+        ('returnTicker (muted)', _time(facade.returnTicker, number)),
+        ('inspect.stack() alone', _time(_caller_name, max(1, number // 20))),
+    ]
+    print("unverified wrap: {0:8.2f} us".format(raw))
+    for name, t in rows:
+        print("{0:>22}: {1:8.2f} us  (overhead {2:8.2f} us)".format(
+            name, t, t - raw))
+
+
+def grid_bytes(g):
+    "Approximate memory held by one grid and its arrays."
+    return sum(sys.getsizeof(part) for part in (
+        g, g.rates, g.sizes, g.ids, g.states))
+
+
+@arg('--markets', help="Number of markets to build a grid for")
+@arg('--levels', help="Levels per grid")
+def grids(markets=1000, levels=50):
+    "Time and measure building a sell grid for every market."
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    built = [
+        SellGrid(pair='BTC-C{0}'.format(i), current_market_price=0.0001 + i * 1e-8,
+                 majorLevel=1, increments=1, numberOfOrders=levels, size=10)
+        for i in range(markets)
+    ]
+    elapsed = time.time() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print("{0} grids x {1} levels built in {2:.3f} s".format(
+        markets, levels, elapsed))
+    print("grid objects: {0:.1f} KiB, peak RSS grew {1} KiB".format(
+        sum(grid_bytes(g) for g in built) / 1024.0, rss_after - rss_before))
+
+
+def bench_config(pairs, levels=5, ticker_ttl=10):
+    "An account config for `pairs` simulated markets."
+    config = ConfigParser.RawConfigParser()
+    config.add_section('pairs')
+    config.set('pairs', 'pairs', ' '.join(pairs))
+    config.add_section('initialcorepositions')
+    for pair in pairs:
+        config.set('initialcorepositions', pair.split('-')[1], 1000)
+    for section in ('sellgrid', 'buygrid'):
+        config.add_section(section)
+        config.set(section, 'majorLevel', 1)
+        config.set(section, 'numberOfOrders', levels)
+        config.set(section, 'size', 30)
+        config.set(section, 'increments', 1)
+    config.set('buygrid', 'profitTarget', 6)
+    config.add_section('cache')
+    config.set('cache', 'tickerTTL', ticker_ttl)
+    return config
+
+
+def simulated_tradepad(n_pairs, levels=5, book_depth=None):
+    "A TradePad wired to a fresh simulated exchange with n_pairs markets."
+    pairs = ['BTC-C{0}'.format(i) for i in range(n_pairs)]
+    config = bench_config(pairs, levels)
+    quotes = dict((pair, dict(bid=0.000999, ask=0.001001)) for pair in pairs)
+    if book_depth:
+        for quote in quotes.values():
+            quote['sell'] = [
+                (0.001001 * (1 + 0.0001 * i), 1.0) for i in range(book_depth)]
+    balances = dict((pair.split('-')[1], 1000.0) for pair in pairs)
+    balances['BTC'] = 1000.0
+
+    engine = simulator.MatchingEngine([quotes], balances)
+    tp = TradePad(config)
+    tp.exchange = exchange.exchangeFactory('sim', config, engine=engine)
+    return tp, engine
+
+
+class Suite(object):
+    """Run benchmark cases and record wall time, API calls and memory.
+
+    API calls are counted by the simulated exchange. Memory is the
+    process's peak resident set, and how much each case grew it.
+    """
+
+    def __init__(self):
+        self.results = dict()
+
+    def measure(self, name, engine, func, repeat=1):
+        calls_before = sum(engine.calls.values())
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        for _ in range(repeat):
+            func()
+        wall = (time.time() - start) / repeat
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        self.results[name] = dict(
+            wall=wall,
+            api_calls=(sum(engine.calls.values()) - calls_before) / float(repeat),
+            peak_rss_kib=rss_after,
+            rss_growth_kib=rss_after - rss_before,
+        )
+        print("{0:>28}: {1:9.4f} s {2:8.1f} calls {3:8d} KiB".format(
+            name, wall, self.results[name]['api_calls'], rss_after - rss_before))
+
+    def rate_for(self, depth):
+        tp, engine = simulated_tradepad(1, book_depth=depth)
+        self.measure(
+            'rate_for depth={0}'.format(depth), engine,
+            lambda: tp.rate_for(tp.exchange, 'BTC-C0', depth * 0.0009), 20)
+
+    def grids(self, n_pairs, levels):
+        tp, engine = simulated_tradepad(n_pairs, levels)
+        self.measure(
+            'build_new_grids pairs={0}'.format(n_pairs), engine,
+            tp.build_new_grids)
+        self.measure(
+            'issue_trades pairs={0}'.format(n_pairs), engine, tp.issue_trades)
+        return tp, engine
+
+    def poll(self, n_pairs, levels, fills):
+        "One poll cycle in which `fills` buy levels have filled."
+        tp, engine = simulated_tradepad(n_pairs, levels)
+        tp.build_new_grids()
+        tp.issue_trades()
+
+        filled = 0
+        for market in sorted(tp.grids):
+            take = min(levels, fills - filled)
+            if take <= 0:
+                break
+            rate = float(tp.grids[market]['buy'].rate(take - 1))
+            engine.set_quotes({market: dict(bid=rate * 0.999, ask=rate)})
+            filled += take
+
+        self.measure(
+            'poll pairs={0} fills={1}'.format(n_pairs, fills), engine, tp.poll)
+
+    def verify(self):
+        tp, engine = simulated_tradepad(1)
+        order_id = engine.place('BTC-C0', 'buy', 0.0009, 1.0)
+        self.measure(
+            'verify isOpen', engine,
+            lambda: tp.exchange.isOpen(order_id), 1000)
+
+    def numbers(self):
+        tp, engine = simulated_tradepad(1)
+        self.measure(
+            'F grid arithmetic', engine,
+            lambda: sell_levels(F, '0.00012345', 1, 1, 20), 1000)
+
+    def startup(self):
+        wall, loaded = startup_time()
+        self.results['import main'] = dict(
+            wall=wall, api_calls=0, eager_imports=loaded)
+        print("{0:>28}: {1:9.4f} s  eager: {2}".format(
+            'import main', wall, ' '.join(loaded) or 'none'))
+
+
+# Modules the CLI must not import until a code path needs them.
+# What `benchmark.py startup` allows a cold import of main by default.
+STARTUP_MAX_MS = 250.0
+
+LAZY_MODULES = ('requests', 'poloniex', 'bittrex', 'tabulate', 'retry', 'sympy')
+
+STARTUP = '''
+import sys, time
+start = time.time()
+import main
+print(time.time() - start)
+print(' '.join(m for m in {0!r} if m in sys.modules))
+'''.format(LAZY_MODULES)
+
+
+def import_main():
+    "(seconds to import main in a fresh interpreter, lazy modules it loaded)."
+    out = subprocess.check_output(
+        [sys.executable, '-c', STARTUP],
+        cwd=os.path.dirname(os.path.abspath(__file__))).splitlines()
+    return float(out[0]), out[1].split() if len(out) > 1 else []
+
+
+def startup_time(repeat=5):
+    "The best of `repeat` cold imports of main, and the lazy modules loaded."
+    runs = [import_main() for _ in range(repeat)]
+    return min(t for t, _ in runs), runs[0][1]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@arg('--output', help="JSON file the results are written to")
+@arg('--pairs', help="Markets in the grid and poll cases")
+@arg('--levels', help="Levels per grid")
+@arg('--fills', help="Filled levels in the poll case")
+@arg('--depth', help="Order book depth in the rate_for case")
+@arg('--verbose', help="Keep debug logging on while timing")
+def suite(output='benchmark.json', pairs=30, levels=5, fills=10, depth=5000,
+          verbose=False):
+    "Run every hot-path benchmark against the simulator and save the results."
+    if not verbose:
+        logging.disable(logging.DEBUG)
+
+    s = Suite()
+    s.rate_for(depth)
+    s.grids(pairs, levels)
+    s.poll(pairs, levels, fills)
+    s.verify()
+    s.numbers()
+    s.startup()
+
+    with open(output, 'w') as f:
+        json.dump(dict(
+            commit=git_commit(),
+            date=time.strftime('%Y-%m-%d %H:%M:%S'),
+            results=s.results,
+        ), f, indent=2, sort_keys=True)
+    print("Results written to {0}".format(output))
+
+
+@arg('--max-ms', help="Fail if importing main takes longer than this")
+@arg('--repeat', help="Cold imports to time; the best is reported")
+def startup(max_ms=STARTUP_MAX_MS, repeat=5):
+    "Time a cold import of main and fail if it is slow or loads lazy modules."
+    wall, loaded = startup_time(repeat)
+    print("import main: {0:.1f} ms".format(wall * 1000))
+    failed = False
+    if loaded:
+        print("imported at startup: {0}".format(' '.join(loaded)))
+        failed = True
+    if wall * 1000 > max_ms:
+        print("slower than {0} ms".format(max_ms))
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+@arg('--threshold', help="Slowdown ratio that counts as a regression")
+def compare(baseline, current, threshold=1.2):
+    "Compare two suite result files and fail on wall-time or API-call regressions."
+    with open(baseline) as f:
+        old = json.load(f)['results']
+    with open(current) as f:
+        new = json.load(f)['results']
+
+    regressions = list()
+    for name in sorted(set(old) & set(new)):
+        for metric in ('wall', 'api_calls'):
+            before, after = old[name][metric], new[name][metric]
+            ratio = after / before if before else (1.0 if not after else float('inf'))
+            flag = ''
+            if ratio > threshold:
+                flag = '  REGRESSION'
+                regressions.append((name, metric))
+            print("{0:>28} {1:>9}: {2:10.4f} -> {3:10.4f} ({4:5.2f}x){5}".format(
+                name, metric, before, after, ratio, flag))
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    dispatch_commands([numbers, verify, grids, startup, suite, compare])
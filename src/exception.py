@@ -11,6 +11,18 @@ class DustTrade(Exception):
 
 class InvalidDictionaryKey(Exception):
     pass
+
+class InsufficientLiquidity(Exception):
+    pass
+
+class CancelFailed(Exception):
+    pass
+
+class OrderNotOpen(CancelFailed):
+    pass
+
+class UnknownMarket(KeyError):
+    pass
 # -*- coding: utf-8 -*-
 
 
@@ -22,4 +34,12 @@ def identify_and_raise(error_text):
         raise NotEnoughCoin(error_text)
                 
     if 'INSUFFICIENT_FUNDS' in error_text:
-        raise NotEnoughCoin(error_text)        
\ No newline at end of file
+        raise NotEnoughCoin(error_text)        
+
+
+def raise_cancel_failed(error_text):
+    # The order had already filled or been cancelled.
+    if 'ORDER_NOT_OPEN' in error_text or 'Invalid order number' in error_text:
+        raise OrderNotOpen(error_text)
+
+    raise CancelFailed(error_text)
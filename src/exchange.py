@@ -1,21 +1,22 @@
 # core
-import inspect
+import functools
+import heapq
+import itertools
 import logging
-import pprint
+import threading
+import time
 
 # 3rd party
 from box import Box
-from forwardable import forwardable
-import poloniex
-from bittrex import bittrex
 
 # local
 import exception
-from mynumbers import F, CF
+import metrics
+from mylogging import Lazy, pretty
+from mynumbers import F, CF, Fixed
+import pool
 
 
-logging.basicConfig(level=logging.DEBUG)
-
 
 class APIData(Box):
     pass
@@ -35,7 +36,7 @@ class PoloniexAPIData(APIData):
     def midPoint(self):
         hb = self.highestBid
         la = self.lowestAsk
-        logging.debug("tla {} thb {}".format(type(la), type(hb)))
+        logging.debug("tla %s thb %s", type(la), type(hb))
         return (F(self.highestBid) + F(self.lowestAsk)) / 2.0
 
     # Created to catch failed order placements.
@@ -73,7 +74,386 @@ wrapper = dict(
     polo=poloniex_api_data,
 )
 
+
+# Request priority classes, most urgent first. Cancels and trades change
+# our exposure; market data feeds decisions; account reads can wait.
+CANCEL, TRADE, MARKET_DATA, ACCOUNT = range(4)
+PRIORITY_NAMES = ('cancel', 'trade', 'market_data', 'account')
+
+PRIORITIES = dict(
+    cancel=CANCEL,
+    cancelOrder=CANCEL,
+    sell=TRADE,
+    sell_limit=TRADE,
+    buy=TRADE,
+    buy_limit=TRADE,
+    get_market_summaries=MARKET_DATA,
+    get_markets=MARKET_DATA,
+    get_orderbook=MARKET_DATA,
+    returnTicker=MARKET_DATA,
+    returnOrderBook=MARKET_DATA,
+)
+
+
+def priority_of(method_name):
+    return PRIORITIES.get(method_name, ACCOUNT)
+
+
+class TokenBucket(object):
+    """A per-exchange token bucket that serves waiting requests by priority.
+
+    Tokens accrue at `rate` per second up to `burst`. When requests queue
+    for a token, the most urgent class goes first, and requests within a
+    class go in arrival order. Time spent waiting is totalled per class.
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.stamp = time.time()
+        self.cond = threading.Condition()
+        self.waiting = list()
+        self.tickets = itertools.count()
+        self.stats = dict(
+            (name, dict(requests=0, waited=0.0, max_wait=0.0, coalesced=0))
+            for name in PRIORITY_NAMES
+        )
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def acquire(self, priority=ACCOUNT):
+        start = time.time()
+        if self.rate:
+            with self.cond:
+                ticket = (priority, next(self.tickets))
+                heapq.heappush(self.waiting, ticket)
+                while True:
+                    self.refill()
+                    if self.waiting[0] == ticket and self.tokens >= 1:
+                        heapq.heappop(self.waiting)
+                        self.tokens -= 1
+                        self.cond.notify_all()
+                        break
+                    timeout = None
+                    if self.waiting[0] == ticket:
+                        timeout = (1 - self.tokens) / self.rate
+                    self.cond.wait(timeout)
+
+        self.record(priority, time.time() - start)
+
+    def record(self, priority, waited):
+        stats = self.stats[PRIORITY_NAMES[priority]]
+        stats['requests'] += 1
+        stats['waited'] += waited
+        stats['max_wait'] = max(stats['max_wait'], waited)
+
+    def metrics(self):
+        "Requests, coalesced duplicates and throttle waits per priority class."
+        with self.cond:
+            return dict(
+                (name, dict(stats)) for name, stats in self.stats.items())
+
+
+class InFlight(object):
+    "A read some thread is already making, for duplicates to wait on."
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ThrottledAPI(object):
+    """Proxy an exchange client so that every call waits its turn.
+
+    Reads (everything but cancels and trades) that are identical to one
+    already in flight wait for its answer rather than spending a token.
+    """
+
+    def __init__(self, api, limiter):
+        self.api = api
+        self.limiter = limiter
+        self.in_flight = dict()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.api, name)
+        if not callable(attr):
+            return attr
+
+        priority = priority_of(name)
+
+        def call(*args, **kwargs):
+            if priority in (CANCEL, TRADE):
+                self.limiter.acquire(priority)
+                return attr(*args, **kwargs)
+            return self.coalesce(name, priority, attr, args, kwargs)
+
+        return call
+
+    def coalesce(self, name, priority, attr, args, kwargs):
+        key = (name, args, tuple(sorted(kwargs.items())))
+        with self.lock:
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = InFlight()
+
+        if not leader:
+            self.limiter.stats[PRIORITY_NAMES[priority]]['coalesced'] += 1
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            self.limiter.acquire(priority)
+            flight.result = attr(*args, **kwargs)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            flight.done.set()
+
+
+class TickerCache(object):
+    """A snapshot of every market's ticker (or other data), indexed by market name.
+
+    One fetch serves all lookups until the snapshot is `ttl` seconds old
+    or is invalidated because we changed the market with an order.
+    """
+
+    def __init__(self, fetch, ttl=0):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.index = None
+        self.fetched_at = 0
+
+    def stale(self):
+        return self.index is None or time.time() - self.fetched_at >= self.ttl
+
+    def get(self, market):
+        with self.lock:
+            if self.stale():
+                self.index = self.fetch()
+                self.fetched_at = time.time()
+            index = self.index
+
+        if market not in index:
+            raise exception.UnknownMarket("{} market not found".format(market))
+        return index[market]
+
+    def invalidate(self):
+        with self.lock:
+            self.index = None
+
+
+class MarketRules(object):
+    """What one market accepts: the smallest quantity and order value, the
+    price tick and the decimal places a quantity may have.
+
+    Ticks and quantity steps are counted in 1e-8 units, as Fixed holds them.
+    """
+
+    __slots__ = ('min_size', 'min_total', 'tick', 'step')
+
+    def __init__(self, min_size=0, min_total=0, tick=1, precision=8):
+        self.min_size = F(min_size)
+        self.min_total = F(min_total)
+        self.tick = tick
+        self.step = 10 ** (8 - precision)
+
+    @staticmethod
+    def _multiple(n, step, up=False):
+        q, r = divmod(F(n).units, step)
+        if r and up:
+            q += 1
+        return Fixed.from_units(q * step)
+
+    def round(self, side, rate, amount):
+        """Put rate on the tick, away from the market, and cut amount to
+        its precision, so an order never costs more than was asked."""
+        return (
+            self._multiple(rate, self.tick, up=(side == 'sell')),
+            self._multiple(amount, self.step),
+        )
+
+    def allows(self, rate, amount):
+        return amount >= self.min_size and rate * amount >= self.min_total
+
+
+class BalanceCache(object):
+    """Every currency's balance from one fetch, answered from memory.
+
+    Between fetches our own activity is applied locally: placing an order
+    reserves what it may spend, and a fill moves coin and BTC between
+    currencies. Fees and anything done elsewhere are picked up when the
+    snapshot is reconciled with the exchange, every `ttl` seconds or once
+    it has been invalidated.
+    """
+
+    def __init__(self, fetch, ttl=0):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.balances = None
+        self.fetched_at = 0
+
+    def stale(self):
+        return self.balances is None or time.time() - self.fetched_at >= self.ttl
+
+    def _current(self):
+        if self.stale():
+            self.balances = self.fetch()
+            self.fetched_at = time.time()
+        return self.balances
+
+    def snapshot(self):
+        "{currency: {Currency:, Balance:, Available:}} for every currency held."
+        with self.lock:
+            return dict(
+                (currency, dict(entry))
+                for currency, entry in self._current().items()
+            )
+
+    def get(self, currency):
+        with self.lock:
+            entry = self._current().get(currency)
+        if entry is None:
+            return dict(Currency=currency, Balance=0.0, Available=0.0)
+        return dict(entry)
+
+    def apply(self, currency, balance=0.0, available=0.0):
+        "Adjust one currency's Balance and Available until the next reconcile."
+        with self.lock:
+            if self.balances is None:
+                return
+            entry = self.balances.setdefault(
+                currency, dict(Currency=currency, Balance=0.0, Available=0.0))
+            entry['Balance'] = float(entry['Balance']) + balance
+            entry['Available'] = float(entry['Available']) + available
+
+    def invalidate(self):
+        with self.lock:
+            self.balances = None
+
+
+class PayloadLog(object):
+    """Debug-log verified payloads lazily, one call in every `every` per method.
+
+    Payloads are handed to logging as Lazy arguments, so they are turned
+    into text on the log writer's thread, not the caller's.
+    """
+
+    def __init__(self, every=1):
+        self.every = max(1, every)
+        self.counts = dict()
+
+    def __call__(self, method, r):
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
+
+        n = self.counts.get(method, 0)
+        self.counts[method] = n + 1
+        if n % self.every:
+            return
+
+        logging.debug("<%s>%s</%s>", method, Lazy(str, r), method)
+
+
+def verified(mute=False):
+    """Verify the raw response a facade method returns.
+
+    The method's own name labels the logged payload, so verify() never has
+    to inspect the stack to find out who called it.
+    """
+    def decorate(method):
+        name = method.__name__
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            return self.verify(method(self, *args, **kwargs), name, mute)
+
+        return wrapper
+
+    return decorate
+
+
+def payload_every(config):
+    "Log one payload in this many per facade method, from the [logging] section."
+    if config.has_option('logging', 'payloadEvery'):
+        return config.getint('logging', 'payloadEvery')
+    return 1
+
+
+def workers(config):
+    "Concurrent requests a facade may have in flight, from [execution]."
+    if config.has_option('execution', 'workers'):
+        return config.getint('execution', 'workers')
+    return 8
+
+
+def retries(config):
+    "Attempts made at a request that fails transiently, from [execution]."
+    if config.has_option('execution', 'retries'):
+        return config.getint('execution', 'retries')
+    return 3
+
+
+def ticker_ttl(config):
+    "Seconds a ticker snapshot stays valid, from the [cache] section."
+    if config.has_option('cache', 'tickerTTL'):
+        return config.getfloat('cache', 'tickerTTL')
+    return 5
+
+
+def market_ttl(config):
+    "Seconds market trading rules are kept before refetching, from [cache]."
+    if config.has_option('cache', 'marketTTL'):
+        return config.getfloat('cache', 'marketTTL')
+    return 86400
+
+
+def balance_ttl(config):
+    "Seconds between reconciling balances with the exchange, from [cache]."
+    if config.has_option('cache', 'balanceTTL'):
+        return config.getfloat('cache', 'balanceTTL')
+    return 60
+
+
+def request_budget(config, exchange_label):
+    "Requests per second allowed for an exchange, from the [ratelimit] section."
+    if config.has_option('ratelimit', exchange_label):
+        return config.getfloat('ratelimit', exchange_label)
+    return None
+
+
+def request_burst(config):
+    "Requests that may go out back to back after a quiet spell."
+    if config.has_option('ratelimit', 'burst'):
+        return config.getint('ratelimit', 'burst')
+    return 1
+
+
 def exchangeFactory(exchange_label, config, **kwargs):
+    # The exchange clients and requests are slow to import, so only the
+    # chosen exchange's client is loaded, and only from here.
+    kwargs['requests_per_second'] = request_budget(config, exchange_label)
+    kwargs['burst'] = request_burst(config)
+    kwargs['ticker_ttl'] = ticker_ttl(config)
+    kwargs['balance_ttl'] = balance_ttl(config)
+    kwargs['payload_every'] = payload_every(config)
+    kwargs['workers'] = workers(config)
+    kwargs['retries'] = retries(config)
 
     if exchange_label == 'polo':
         kwargs['extend'] = True
@@ -84,28 +464,103 @@ def exchangeFactory(exchange_label, config, **kwargs):
 
         kwargs['loglevel'] = logging.DEBUG
 
+        import poloniex
+        import transport
+        transport.install(transport.from_config(config), poloniex)
         return PoloniexFacade(**kwargs)
 
+    if exchange_label == 'sim':
+        import simulator
+        engine = kwargs.pop('engine', None)
+        if engine is None:
+            engine = simulator.engine_from_config(config)
+        kwargs['market_ttl'] = market_ttl(config)
+        return BittrexFacade(api=simulator.SimulatedBittrex(engine), **kwargs)
+
     if exchange_label == 'bittrex':
 
         kwargs['api_key'] = config.get('api', 'key')
         kwargs['api_secret'] = config.get('api', 'secret')
+        kwargs['market_ttl'] = market_ttl(config)
 
+        from bittrex import bittrex
+        import transport
+        transport.install(transport.from_config(config), bittrex)
         return BittrexFacade(**kwargs)
 
+# Failures worth retrying: network errors, which requests raises as IOError.
+TRANSIENT = (IOError,)
+
+FACADE_OPTIONS = (
+    'requests_per_second', 'burst', 'ticker_ttl', 'balance_ttl',
+    'payload_every', 'workers', 'retries', 'tickers')
+
+
+def facade_options(kwargs):
+    "Remove and return the kwargs meant for the facade, not the exchange client."
+    return dict(
+        (option, kwargs.pop(option))
+        for option in FACADE_OPTIONS if option in kwargs
+    )
+
+
 class ExchangeFacade(object):
     # verify() and swap() are abstract methods!
-    pass
 
-@forwardable()
+    def __init__(self, api, requests_per_second=None, burst=1, ticker_ttl=0,
+                 balance_ttl=0, payload_every=1, workers=8, retries=3,
+                 tickers=None):
+        self.limiter = TokenBucket(requests_per_second, burst)
+        self.api = ThrottledAPI(api, self.limiter)
+        # Accounts on the same exchange may pass one TickerCache to share.
+        if tickers is None:
+            tickers = TickerCache(self.tickerIndex, ticker_ttl)
+        self.tickers = tickers
+        self.balances = BalanceCache(self.balanceIndex, balance_ttl)
+        self.payload_log = PayloadLog(payload_every)
+        self.workers = workers
+        self.retries = retries
+        self.stream = None
+
+    def attach_stream(self, stream):
+        "Answer tickers and sell books from a stream.MarketDataStream when it is fresh."
+        self.stream = stream
+
+    def cancelOrders(self, order_numbers):
+        """Cancel orders concurrently, retrying transient failures.
+
+        Returns a dict mapping each order number to True once the exchange
+        has confirmed the cancel, or to the exception that finally stopped it.
+        """
+        from retry.api import retry_call
+        logging.debug("cancelOrders %s", order_numbers)
+
+        def cancel(order_number):
+            return retry_call(
+                self.cancelOrder, fargs=[order_number], exceptions=TRANSIENT,
+                tries=self.retries, delay=0.5, backoff=2)
+
+        outcomes = pool.parallel_map(cancel, order_numbers, self.workers)
+        return dict((o.item, o.error or True) for o in outcomes)
+
+
 class PoloniexFacade(ExchangeFacade):
-    def_delegators(
-        'api',
-        'returnBalances, returnCompleteBalances, returnTicker'
-    )
 
-    def __init__(self, **kwargs):
-        self.api = poloniex.Poloniex(**kwargs)
+    def __init__(self, api=None, **kwargs):
+        options = facade_options(kwargs)
+        if api is None:
+            import poloniex
+            api = poloniex.Poloniex(**kwargs)
+        ExchangeFacade.__init__(self, api, **options)
+
+    def returnBalances(self):
+        return self.api.returnBalances()
+
+    def returnCompleteBalances(self):
+        return self.api.returnCompleteBalances()
+
+    def returnTicker(self):
+        return self.api.returnTicker()
 
     def currency2pair(self, base, quote, uppercase=True):
         v = "{0}_{1}".format(base, quote)
@@ -115,20 +570,66 @@ class PoloniexFacade(ExchangeFacade):
 
     def cancelAllOpen(self):
         orderdict = self.api.returnOpenOrders()
-        # print "Open Orders {0}".format(orderdict)
-        for pair, orderlist in orderdict.iteritems():
-            if orderlist:
-                self.cancelOrders([o['orderNumber'] for o in orderlist])
-
-    def cancelOrders(self, order_numbers):
-        logging.debug("cancelOrders {0}".format(order_numbers))
-        for order_number in order_numbers:
-            logging.debug("cancelling {0}".format(order_number))
-            self.cancelOrder(order_number)
+        return self.cancelOrders([
+            o['orderNumber']
+            for orderlist in orderdict.values()
+            for o in orderlist
+        ])
+
+    def openOrderIds(self):
+        orderdict = self.api.returnOpenOrders('all')
+        return set(
+            str(o['orderNumber'])
+            for orderlist in orderdict.values()
+            for o in orderlist
+        )
+
+    def openOrders(self):
+        "Every open order as dict(id=, market=, side=, rate=, amount=)."
+        orderdict = self.api.returnOpenOrders('all')
+        return [
+            dict(id=str(o['orderNumber']), market=market, side=o['type'],
+                 rate=F(o['rate']), amount=F(o['amount']))
+            for market, orderlist in orderdict.items()
+            for o in orderlist
+        ]
+
+    def cancelledOrderIds(self):
+        # Poloniex keeps no history of cancelled orders.
+        return set()
+
+    def tickerIndex(self):
+        all_markets_ticker = self.returnTicker()
+        return dict(
+            (market, PoloniexAPIData(ticker))
+            for market, ticker in all_markets_ticker.items()
+        )
+
+    def tickerFromQuote(self, market, bid, ask):
+        return PoloniexAPIData(highestBid=bid, lowestAsk=ask)
+
+    def balanceIndex(self):
+        return dict(
+            (currency, dict(
+                Currency=currency,
+                Balance=float(b['available']) + float(b['onOrders']),
+                Available=float(b['available'])))
+            for currency, b in self.returnCompleteBalances().items()
+        )
+
+    def recordFill(self, market, side, rate, amount):
+        # Poloniex balances are not adjusted locally; reconcile instead.
+        self.balances.invalidate()
+
+    def affordable(self, market, side, levels):
+        # Poloniex orders are left for the exchange to check.
+        return len(levels)
 
     def tickerFor(self, market):
-        all_markets_ticker = self.returnTicker()
-        return PoloniexAPIData(all_markets_ticker[market])
+        quote = self.stream and self.stream.quote(market)
+        if quote:
+            return self.tickerFromQuote(market, *quote)
+        return self.tickers.get(market)
 
     def fillAmount(self, trade_id):
         r = self.api.returnOrderTrades(trade_id)
@@ -141,13 +642,13 @@ class PoloniexFacade(ExchangeFacade):
 
         amount_filled = F(0)
 
-        logging.debug("R={0}".format(pprint.pformat(r)))
+        logging.debug("R=%s", pretty(r))
 
         for v in r:
-            logging.debug("V={0}".format(v))
+            logging.debug("V=%s", v)
             amount_filled += float(v['amount'])
 
-        logging.debug("amount filled = {0}".format(amount_filled))
+        logging.debug("amount filled = %s", amount_filled)
 
         return amount_filled
 
@@ -160,12 +661,22 @@ class PoloniexFacade(ExchangeFacade):
             else:
                 raise Exception("Received dict but not error in it.")
 
-        logging.debug("returnOrderTrades={0}".format(pprint.pformat(r)))
+        logging.debug("returnOrderTrades=%s", pretty(r))
+
+        return r
 
+    def cancelOrder(self, order_number):
+        r = self.api.cancelOrder(order_number)
+        self.tickers.invalidate()
+        self.balances.invalidate()
+        if r.get('error'):
+            exception.raise_cancel_failed(r.get('error'))
         return r
 
     def buy(self, market, rate, amount):
         r = self.api.buy(market, rate, amount)
+        self.tickers.invalidate()
+        self.balances.invalidate()
         if r.get('error'):
             exception.identify_and_raise(r.get('error'))
         return r
@@ -173,14 +684,24 @@ class PoloniexFacade(ExchangeFacade):
     def sell(self, market, rate, amount):
         logging.debug("Placing trade")
         r = self.api.sell(market, rate, amount)
+        self.tickers.invalidate()
+        self.balances.invalidate()
         if r.get('error'):
             exception.identify_and_raise(r.get('error'))
         logging.debug("trace place result=%s", r)
         return r
 
 class BittrexFacade(PoloniexFacade):
-    def __init__(self, **kwargs):
-        self.api = bittrex.Bittrex(**kwargs)
+    # Bittrex refuses orders in BTC markets worth less than this.
+    MIN_TOTAL = '0.0005'
+
+    def __init__(self, api=None, market_ttl=86400, **kwargs):
+        options = facade_options(kwargs)
+        if api is None:
+            from bittrex import bittrex
+            api = bittrex.Bittrex(**kwargs)
+        ExchangeFacade.__init__(self, api, **options)
+        self.markets = TickerCache(self.marketIndex, market_ttl)
 
     def wrap(self, data):
         if isinstance(data, dict):
@@ -189,33 +710,82 @@ class BittrexFacade(PoloniexFacade):
         if isinstance(data, list):
             return data
 
-    def verify(self, r):
-        mute_methods = 'return SellOrderBook returnOrderBook returnPositiveBalances returnTicker cancelAllOpen'
+    def verify(self, r, method='verify', mute=False):
         if not r.get('success'):
             exception.identify_and_raise(r.get('message'))
         r = self.wrap(r['result'])
 
-        method = inspect.stack()[1][3]
-        if method not in mute_methods:
-            logging.debug("<{}>{}</{}>".format(method, r, method))
+        if not mute:
+            self.payload_log(method, r)
         return r
 
     def returnCompleteBalances(self):
         r = self.api.get_balances()
-        logging.debug("Balances: {}".format(pprint.pformat(r)))
+        logging.debug("Balances: %s", pretty(r))
+
+    def balanceIndex(self):
+        b = self.verify(self.api.get_balances(), 'balanceIndex', mute=True)
+        return dict((entry['Currency'], entry) for entry in b)
 
     def returnPositiveBalances(self):
-        b = self.verify(self.api.get_balances())
         r = dict()
-        for pair in b:
-            if pair['Balance'] > 0:
-                pair['TOTAL'] = pair['Balance']
-                r[pair['Currency']] = pair
+        for currency, entry in self.balances.snapshot().items():
+            if entry['Balance'] > 0:
+                entry['TOTAL'] = entry['Balance']
+                r[currency] = entry
         return r
 
     def returnBalance(self, currency):
-        b = self.verify(self.api.get_balance(currency))
-        return b
+        return self.balances.get(currency)
+
+    def marketIndex(self):
+        markets = self.verify(self.api.get_markets(), 'marketIndex', mute=True)
+        return dict(
+            (m['MarketName'], MarketRules(
+                min_size=m['MinTradeSize'],
+                min_total=self.MIN_TOTAL if m['BaseCurrency'] == 'BTC' else 0))
+            for m in markets
+        )
+
+    def spends(self, market, side, rate, amount):
+        "The currency an order reserves, and how much of it."
+        if side == 'buy':
+            return self.quoteOf(market), rate * amount
+        return self.baseOf(market), amount
+
+    def prepareOrder(self, market, side, rate, amount):
+        """Round an order to the market's rules and check it locally.
+
+        Raises DustTrade or NotEnoughCoin, without a request, for an order
+        the exchange would refuse.
+        """
+        rate, amount = self.markets.get(market).round(side, rate, amount)
+        if not self.markets.get(market).allows(rate, amount):
+            raise exception.DustTrade(
+                "{0} {1} {2} @ {3} is below the market minimum".format(
+                    side, market, amount, rate))
+
+        currency, cost = self.spends(market, side, rate, amount)
+        available = self.balances.get(currency)['Available']
+        if cost > available:
+            raise exception.NotEnoughCoin(
+                "{0} {1} {2} @ {3} needs {4} {5}, {6} available".format(
+                    side, market, amount, rate, cost, currency, available))
+        return rate, amount
+
+    def affordable(self, market, side, levels):
+        """How many of levels, [(rate, amount)] nearest the market first,
+        can be placed without dust or running out of the balance."""
+        rules = self.markets.get(market)
+        currency, _ = self.spends(market, side, 0, 0)
+        available = F(self.balances.get(currency)['Available'])
+        for n, (rate, amount) in enumerate(levels):
+            rate, amount = rules.round(side, rate, amount)
+            cost = self.spends(market, side, rate, amount)[1]
+            if not rules.allows(rate, amount) or cost > available:
+                return n
+            available -= cost
+        return len(levels)
 
     def returnBalanceFromMarket(self, market):
         base = self.baseOf(market)
@@ -232,47 +802,110 @@ class BittrexFacade(PoloniexFacade):
         return self.baseAndQuote(market_name)[1]
 
     def cancelAllOpen(self):
-        open_orders = self.verify(self.api.get_open_orders())
+        open_orders = self.verify(
+            self.api.get_open_orders(), 'cancelAllOpen', mute=True)
         logging.debug("Open Orders %s", open_orders)
-        for open_order in open_orders:
-            self.api.cancel(open_order['OrderUuid'])
+        return self.cancelOrders([o['OrderUuid'] for o in open_orders])
+
+    def openOrderIds(self):
+        open_orders = self.verify(
+            self.api.get_open_orders(), 'openOrderIds', mute=True)
+        return set(o['OrderUuid'] for o in open_orders)
+
+    def openOrders(self):
+        "Every open order as dict(id=, market=, side=, rate=, amount=)."
+        open_orders = self.verify(
+            self.api.get_open_orders(), 'openOrders', mute=True)
+        return [
+            dict(id=o['OrderUuid'], market=o['Exchange'],
+                 side='buy' if o['OrderType'] == 'LIMIT_BUY' else 'sell',
+                 rate=F(o['Limit']), amount=F(o['Quantity']))
+            for o in open_orders
+        ]
+
+    def cancelledOrderIds(self):
+        "Recent orders that closed without anything being filled."
+        history = self.verify(
+            self.api.get_order_history(), 'cancelledOrderIds', mute=True)
+        return set(
+            o['OrderUuid'] for o in history
+            if o['QuantityRemaining'] >= o['Quantity']
+        )
 
     def cancelOrder(self, o):
-        self.api.cancel(o)
+        r = self.api.cancel(o)
+        self.tickers.invalidate()
+        # What the cancel released is not known here, so reconcile.
+        self.balances.invalidate()
+        if not r.get('success'):
+            exception.raise_cancel_failed(r.get('message') or '')
+        return r
 
+    def recordFill(self, market, side, rate, amount):
+        "Move a filled order's coin and BTC in the balance snapshot."
+        base, quote = self.baseAndQuote(market)
+        amount, cost = float(amount), float(amount) * float(rate)
+        if side == 'buy':
+            self.balances.apply(quote, balance=-cost)
+            self.balances.apply(base, balance=amount, available=amount)
+        else:
+            self.balances.apply(base, balance=-amount)
+            self.balances.apply(quote, balance=cost, available=cost)
+
+    @verified(mute=True)
     def returnTicker(self):
-        return self.verify(self.api.get_market_summaries())
+        return self.api.get_market_summaries()
 
+    @verified(mute=True)
     def returnOrderBook(self, market):
-        return self.verify(self.api.get_orderbook(market, 'both'))
+        return self.api.get_orderbook(market, 'both')
 
     def returnSellOrderBook(self, market):
-        return self.verify(self.api.get_orderbook(market, 'sell'))
+        orders = self.stream and self.stream.sell_orders(market)
+        if orders:
+            return orders
+        return self.restSellOrderBook(market)
 
+    @verified(mute=True)
+    def restSellOrderBook(self, market):
+        return self.api.get_orderbook(market, 'sell')
 
+    def tickerFromQuote(self, market, bid, ask):
+        return self.wrap(dict(MarketName=market, Bid=bid, Ask=ask))
 
-    def tickerFor(self, market):
+
+
+    def tickerIndex(self):
         all_markets_ticker = self.returnTicker()
-        for ticker in all_markets_ticker:
-            if ticker['MarketName'] == market:
-                ticker = self.wrap(ticker)
-                logging.debug("Ticker for {} = {}".format(market, ticker))
-                return ticker
-        raise Exception("{} market not found".format(market))
+        return dict(
+            (ticker['MarketName'], self.wrap(ticker))
+            for ticker in all_markets_ticker
+        )
 
     def sell(self, market, rate, amount):
         logging.debug("Placing sell %s, %s, %s", market, rate, amount)
-        r = self.verify(self.api.sell_limit(market, amount, rate))
+        rate, amount = self.prepareOrder(market, 'sell', rate, amount)
+        r = self.verify(self.api.sell_limit(market, amount, rate), 'sell')
+        self.tickers.invalidate()
+        self.balances.apply(self.baseOf(market), available=-float(amount))
         logging.debug("sell limit result=%s", r)
         return r
 
     def buy(self, market, rate, amount):
         logging.debug("Placing buy %s, %s, %s", market, rate, amount)
-        r = self.verify(self.api.buy_limit(market, amount, rate))
+        rate, amount = self.prepareOrder(market, 'buy', rate, amount)
+        r = self.verify(self.api.buy_limit(market, amount, rate), 'buy')
+        self.tickers.invalidate()
+        self.balances.apply(
+            self.quoteOf(market), available=-float(amount) * float(rate))
         logging.debug("buy limit result=%s", r)
         return r
 
     def isOpen(self, trade_id):
-        r = self.verify(self.api.get_order(trade_id))
-        logging.debug("result = {}".format(r))
+        r = self.verify(self.api.get_order(trade_id), 'isOpen')
+        logging.debug("result = %s", r)
         return r.IsOpen
+
+
+metrics.instrument(PoloniexFacade, 'exchange')
+metrics.instrument(BittrexFacade, 'exchange')
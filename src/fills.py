@@ -0,0 +1,33 @@
+# core
+import logging
+
+
+class FillDetector(object):
+    """Find filled grid levels for every market with two requests per cycle.
+
+    Rather than asking about each outstanding order, fetch the account's
+    open orders and recently cancelled orders once and diff every grid's
+    order ids against them. An order that is neither open nor cancelled
+    has filled.
+    """
+
+    def __init__(self, exchange):
+        self.exchange = exchange
+        self.open_ids = set()
+
+    def scan(self, grids):
+        """Return {(market, side): deepest filled index or None}.
+
+        The open order ids fetched are kept in open_ids for the caller.
+        """
+        open_ids = self.open_ids = self.exchange.openOrderIds()
+        cancelled_ids = self.exchange.cancelledOrderIds()
+        logging.debug(
+            "%d open orders, %d recently cancelled",
+            len(open_ids), len(cancelled_ids))
+
+        return dict(
+            ((market, side), grid.deepest_filled(open_ids, cancelled_ids))
+            for market, sides in grids.items()
+            for side, grid in sides.items()
+        )
@@ -0,0 +1,221 @@
+# core
+from array import array
+import logging
+
+# local
+from mynumbers import F
+
+
+OPEN, FILLED = 0, 1
+
+
+def pair2currency(pair):
+    btc, currency = pair.split('-')
+    return currency
+
+
+def levels(price, direction, major_level, increments, number_of_orders):
+    """Rates of a grid's levels, nearest the market first.
+
+    The first level is major_level percent away from price and every
+    following one another increments percent further, in direction
+    (+1 above the market, -1 below it).
+    """
+    first = float(price) * (1 + direction * major_level / 100.0)
+    step = 1 + direction * increments / 100.0
+    return array('d', [first * step ** i for i in range(number_of_orders)])
+
+
+class Grid(object):
+    # place() is an abstract method!
+    """A ladder of limit orders on one side of a market.
+
+    Levels live in parallel arrays (rates, sizes, order ids, fill states).
+    Filled levels are purged from the front by advancing `start`, so index
+    0 is always the nearest live level and purging costs O(1); the arrays
+    are compacted once more than half of them is dead.
+    """
+
+    __slots__ = (
+        'pair', 'size', 'profitTarget',
+        'rates', 'sizes', 'ids', 'states', 'start',
+    )
+
+    side = None
+    section = None
+    direction = 0
+
+    def __init__(self, pair=None, current_market_price=None, gridtrader=None,
+                 **parameters):
+        if gridtrader is not None:
+            defaults = gridtrader.settings.grid_parameters(self.section, pair)
+            defaults.update(parameters)
+            parameters = defaults
+
+        self.pair = pair
+        self.size = F(parameters['size'])
+        self.profitTarget = parameters.get('profitTarget', 0)
+        self.rates = levels(
+            current_market_price, self.direction, parameters['majorLevel'],
+            parameters['increments'], parameters['numberOfOrders'])
+
+        n = len(self.rates)
+        self.sizes = array('d', [float(self.size)]) * n
+        self.ids = [None] * n
+        self.states = bytearray(n)
+        self.start = 0
+
+    def __len__(self):
+        return len(self.rates) - self.start
+
+    def __str__(self):
+        s = '<{0} pair={1} size={2}>\n'.format(self.side, self.pair, self.size)
+        for i in range(len(self)):
+            s += '  {0} {1} {2}\n'.format(i, self.rate(i), self.trade_id(i))
+        return s + '</{0}>\n'.format(self.side)
+
+    def rate(self, i):
+        return F(self.rates[self.start + i])
+
+    def size_at(self, i):
+        return F(self.sizes[self.start + i])
+
+    def trade_id(self, i):
+        return self.ids[self.start + i]
+
+    @property
+    def grid(self):
+        return [F(rate) for rate in self.rates[self.start:]]
+
+    @property
+    def trade_ids(self):
+        return self.ids[self.start:]
+
+    def place_orders(self, exchange):
+        """Place an order at every live level, nearest the market first.
+
+        The grid is first cut to the levels the exchange says are
+        affordable and not dust. If the exchange still rejects one, the
+        grid is cut back to the levels that were placed before the error
+        is re-raised.
+        """
+        fits = exchange.affordable(
+            self.pair, self.side,
+            [(self.rate(i), self.size_at(i)) for i in range(len(self))])
+        if fits < len(self):
+            logging.debug(
+                "%s %s grid cut from %d to %d levels to fit the balance",
+                self.pair, self.side, len(self), fits)
+            self.truncate(fits)
+
+        for i in range(len(self)):
+            try:
+                self.place_level(exchange, i)
+            except Exception:
+                self.truncate(i)
+                raise
+        return self
+
+    def place_level(self, exchange, i):
+        "Place the order for live level i and record its id."
+        r = self.place(exchange, self.rate(i), self.size_at(i))
+        self.ids[self.start + i] = r.orderNumber
+
+    def trade_activity(self, exchange):
+        "Index of the deepest level whose order is no longer open, or None."
+        deepest = None
+        for i in range(len(self)):
+            if not exchange.isOpen(self.trade_id(i)):
+                self.states[self.start + i] = FILLED
+                deepest = i
+        return deepest
+
+    def deepest_filled(self, open_ids, cancelled_ids=()):
+        """trade_activity() against sets of open and cancelled order ids.
+
+        No requests are made, so one pair of sets serves every grid.
+        """
+        deepest = None
+        for i in range(self.start, len(self.rates)):
+            trade_id = self.ids[i]
+            if trade_id is None or trade_id in open_ids:
+                continue
+            if trade_id in cancelled_ids:
+                continue
+            self.states[i] = FILLED
+            deepest = i - self.start
+        return deepest
+
+    def truncate(self, n):
+        "Keep only the first n live levels."
+        end = self.start + n
+        del self.rates[end:]
+        del self.sizes[end:]
+        del self.ids[end:]
+        del self.states[end:]
+
+    def purge_closed_trades(self, i):
+        "Drop live levels 0 through i."
+        self.start = min(self.start + i + 1, len(self.rates))
+        if self.start * 2 > len(self.rates):
+            self.compact()
+
+    def compact(self):
+        start = self.start
+        self.rates = self.rates[start:]
+        self.sizes = self.sizes[start:]
+        self.ids = self.ids[start:]
+        self.states = self.states[start:]
+        self.start = 0
+
+    def to_state(self):
+        "Plain data for persistence."
+        start = self.start
+        return dict(
+            side=self.side,
+            pair=self.pair,
+            size=str(self.size),
+            profitTarget=self.profitTarget,
+            levels=self.rates[start:].tolist(),
+            sizes=self.sizes[start:].tolist(),
+            trade_ids=self.ids[start:],
+            states=list(self.states[start:]),
+        )
+
+    @classmethod
+    def from_state(cls, state):
+        grid = cls.__new__(GRIDS[state['side']])
+        grid.pair = state['pair']
+        grid.size = F(state['size'])
+        grid.profitTarget = state['profitTarget']
+        grid.rates = array('d', state['levels'])
+        grid.sizes = array('d', state['sizes'])
+        grid.ids = list(state['trade_ids'])
+        grid.states = bytearray(state['states'])
+        grid.start = 0
+        return grid
+
+
+class SellGrid(Grid):
+    __slots__ = ()
+
+    side = 'sell'
+    section = 'sellgrid'
+    direction = 1
+
+    def place(self, exchange, rate, amount):
+        return exchange.sell(self.pair, rate=rate, amount=amount)
+
+
+class BuyGrid(Grid):
+    __slots__ = ()
+
+    side = 'buy'
+    section = 'buygrid'
+    direction = -1
+
+    def place(self, exchange, rate, amount):
+        return exchange.buy(self.pair, rate=rate, amount=amount)
+
+
+GRIDS = dict(sell=SellGrid, buy=BuyGrid)
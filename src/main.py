@@ -3,19 +3,27 @@ import ConfigParser
 from datetime import datetime
 import logging
 import os
-import pprint
-import sys
+import threading
 import time
 import traceback
 
 # 3rd party
 from argh import dispatch_command, arg
-from tabulate import tabulate
 
 # local
 import exchange as _exchange
 import exception
+from fills import FillDetector
+from grid import BuyGrid, SellGrid, Grid, GRIDS, pair2currency
+import metrics
+import myconfig
+import mylogging
 from mynumbers import F, CF
+from orderbook import OrderBook
+from persist import Persist, PROFIT
+import pool
+from scheduler import MarketScheduler
+import stream
 
 
 # os.chdir("/home/schemelab/prg/adsactly-gridtrader/src")
@@ -42,11 +50,11 @@ def display_balances(e):
 
     logging.debug("""
 [pairs]
-{}
+%s
 
 [initialcorepositions]
-{}
-""".format(pairs, coinstr))
+%s
+""", pairs, coinstr)
 
 
 def _set_balances(exchange, config_filename, config):
@@ -54,7 +62,7 @@ def _set_balances(exchange, config_filename, config):
     config.remove_section(section)
     config.add_section(section)
 
-    balances = get_balances(exchange)
+    balances = get_balances(exchange, fresh=True)
     for coin in sorted(balances.keys()):
         logging.debug("COIN %s", coin)
         config.set(section, coin, balances[coin]['TOTAL'])
@@ -72,22 +80,26 @@ def display_session_info(session_args, e, end=False):
         amounts = balances[coin]
         balstr += "{}={},".format(coin, amounts['TOTAL'])
 
-    logging.debug("<{}session args={} balances={} date={} >".format(
+    logging.debug(
+        "<%ssession args=%s balances=%s date=%s >",
         forward_slash, session_args, balstr, session_date)
-    )
 
 
 def config_file_name(account):
     return "config/{}.ini".format(account)
 
 
-def persistence_file_name(exch):
-    return "persistence/{0}.storage".format(exch)
+def reload_interval(config):
+    "Seconds between looks at the config file while serving, from [scheduler]."
+    if config.has_option('scheduler', 'reloadInterval'):
+        return config.getfloat('scheduler', 'reloadInterval')
+    return 10.0
 
-def pair2currency(pair):
-    btc, currency = pair.split('-')
-    return currency
 
+def persistence_file_name(exch, account=None):
+    if account is None:
+        return "persistence/{0}.storage".format(exch)
+    return "persistence/{0}-{1}.storage".format(account, exch)
 
 def percent2ratio(i):
     return i / 100.0
@@ -112,8 +124,210 @@ def i_range(a):
 
 class TradePad(object):
 
-    def __init__(self, config):
+    def __init__(self, config, persist=None, account=None):
         self.config = config
+        self.settings = myconfig.Settings(config)
+        self.persist = persist
+        self.account = account
+        self.watcher = None
+        self.grids = dict()
+        # {market: [ids]} of the profit-taking sells placed after buy fills.
+        self.profit = dict()
+        # {market: {id: (rate, amount, profitTarget)}} of buys whose cancel failed.
+        self.stuck = dict()
+        self.market = dict()
+
+    def restore_grids(self, state):
+        "Rebuild grids from persisted state, without touching the exchange."
+        self.grids = dict(
+            (market, dict(
+                (side, Grid.from_state(sides[side]))
+                for side in sides if side != PROFIT
+            ))
+            for market, sides in state.items()
+            if set(sides) - set([PROFIT])
+        )
+        self.profit = dict(
+            (market, list(sides[PROFIT]))
+            for market, sides in state.items() if PROFIT in sides
+        )
+
+    def reconcile(self, state):
+        """Resume persisted grids, keeping the orders still on the exchange.
+
+        Open orders are matched to grid levels by order id or, failing
+        that, by market, side, rate and size. Profit-taking sells still
+        open are kept, in any market. Other orders no grid claims are
+        cancelled. Levels whose order was cancelled while we were away are
+        placed again. Levels whose order is otherwise gone are left for
+        the next poll, which sees them as fills. Configured pairs with no
+        persisted grid get new ones. Returns counts of what was done.
+        """
+        self.restore_grids(state)
+        orders = self.exchange.openOrders()
+        cancelled = self.exchange.cancelledOrderIds()
+
+        by_id = dict((o['id'], o) for o in orders)
+        by_terms = dict()
+        for o in orders:
+            key = (o['market'], o['side'], o['rate'], o['amount'])
+            by_terms.setdefault(key, list()).append(o['id'])
+
+        pairs = self.settings.pairs
+        for market in list(self.grids):
+            if market not in pairs:
+                logging.debug("%s is no longer configured; dropping its grids", market)
+                del self.grids[market]
+
+        claimed, replace = set(), list()
+        for market in list(self.profit):
+            self.profit[market] = [i for i in self.profit[market] if i in by_id]
+            claimed.update(self.profit[market])
+            if not self.profit[market]:
+                del self.profit[market]
+
+        for market, sides in self.grids.items():
+            for side, g in sides.items():
+                for i in range(len(g)):
+                    trade_id = g.trade_id(i)
+                    if trade_id in by_id and trade_id not in claimed:
+                        claimed.add(trade_id)
+                        continue
+                    candidates = [
+                        candidate for candidate in by_terms.get(
+                            (market, side, g.rate(i), g.size_at(i)), ())
+                        if candidate not in claimed
+                    ]
+                    if candidates:
+                        g.ids[g.start + i] = candidates[0]
+                        claimed.add(candidates[0])
+                    elif trade_id in cancelled:
+                        replace.append((g, i))
+
+        unclaimed = [o['id'] for o in orders if o['id'] not in claimed]
+        if unclaimed:
+            self.exchange.cancelOrders(unclaimed)
+
+        for g, i in replace:
+            try:
+                g.place_level(self.exchange, i)
+            except (exception.NotEnoughCoin, exception.DustTrade) as e:
+                logging.debug(
+                    "Could not replace %s %s level %d: %s", g.pair, g.side, i, e)
+
+        built = 0
+        for market in pairs:
+            sides = self.grids.setdefault(market, dict())
+            for side in ('sell', 'buy'):
+                if side in sides:
+                    continue
+                sides[side] = self.place_grid(GRIDS[side](
+                    pair=market,
+                    current_market_price=self.midpoint(market),
+                    gridtrader=self
+                ))
+                built += 1
+
+        counts = dict(
+            adopted=len(claimed), cancelled=len(unclaimed),
+            replaced=len(replace), built=built)
+        logging.debug("Reconciled grids with open orders: %s", counts)
+        return counts
+
+    def watch(self, path, interval=10.0):
+        "Let reload() pick up changes to the config file at path."
+        self.watcher = myconfig.ConfigWatcher(path, interval)
+
+    def reload(self):
+        """Apply a changed config file to the running grids.
+
+        Removed pairs have their orders cancelled, added pairs get new
+        grids, and only the sides whose parameters changed are rebuilt;
+        every other market is left alone. The new grids are all built
+        before any order is touched: if one of them cannot be, say for a
+        pair with no core position or one the exchange does not list, the
+        whole change is rejected and logged. Returns the myconfig.Changes, or None when the file has
+        not changed or was rejected.
+        """
+        settings = self.watcher and self.watcher.poll()
+        if settings is None:
+            return None
+
+        changes = myconfig.diff(self.settings, settings)
+        rebuild = dict(changes.regrid)
+        for market in changes.added:
+            rebuild[market] = [side for side, _ in myconfig.GRID_SECTIONS]
+        try:
+            new_grids = dict(
+                (market, self.new_grids(settings, market, sides))
+                for market, sides in rebuild.items())
+        except (exception.UnknownMarket, KeyError, ValueError,
+                ZeroDivisionError) as e:
+            logging.debug(
+                "Config change rejected, nothing was changed: %s %r",
+                changes, e)
+            return None
+        except Exception:
+            # Most likely the exchange; try the same file again next time.
+            self.watcher.retry()
+            raise
+
+        self.config, self.settings = settings.parser, settings
+        logging.debug("Config reloaded: %s", changes)
+
+        for market in changes.removed:
+            grids = self.grids.pop(market, dict())
+            self.cancel_grids(grids.values())
+            if self.persist is not None:
+                for side in grids:
+                    self.persist.record(market, side, None)
+        for market in sorted(new_grids):
+            self.regrid(market, new_grids[market])
+        return changes
+
+    def cancel_grids(self, grids):
+        ids = [i for g in grids for i in g.trade_ids if i is not None]
+        if ids:
+            self.exchange.cancelOrders(ids)
+
+    def new_grids(self, settings, market, sides):
+        "Unplaced grids for these sides of a market at its midpoint, from settings."
+        price = self.midpoint(market)
+        return dict(
+            (side, GRIDS[side](
+                pair=market,
+                current_market_price=price,
+                **settings.grid_parameters(GRIDS[side].section, market)
+            ))
+            for side in sides
+        )
+
+    def regrid(self, market, new_grids):
+        "Cancel a market's grids on the sides in new_grids and place those instead."
+        grids = self.grids.setdefault(market, dict())
+        self.cancel_grids(
+            [grids[side] for side in new_grids if side in grids])
+        for side, g in new_grids.items():
+            grids[side] = self.place_grid(g)
+        self.save(market)
+
+    def save(self, market):
+        "Journal the current grids and profit sells of one market, if persistence is on."
+        if self.persist is None:
+            return
+        for side in self.grids[market]:
+            self.persist.record(market, side, self.grids[market][side])
+        if market in self.profit:
+            self.persist.record(market, PROFIT, self.profit[market] or None)
+            if not self.profit[market]:
+                del self.profit[market]
+
+    def prune_profit(self, markets, open_ids):
+        "Forget the profit-taking sells of markets that are no longer open."
+        for market in markets:
+            if market in self.profit:
+                self.profit[market] = [
+                    i for i in self.profit[market] if i in open_ids]
 
     def __str__(self):
         s = str()
@@ -125,20 +339,14 @@ class TradePad(object):
 
         return "{0}\n{1}".format(type(self).__name__, s)
 
+    @metrics.timed('tradepad.rate_for')
     def rate_for(self, exchange, mkt, btc):
-        "Return the rate that works for a particular amount of BTC."
+        "Return the limit rate and coin amount that spend a particular amount of BTC."
 
-        coin_amount = 0
-        btc_spent = 0
         logging.debug("Getting sell order book for %s", mkt)
-        orders = exchange.returnSellOrderBook(mkt)
-        for order in orders:
-            btc_spent += order['Rate'] * order['Quantity']
-            if btc_spent > btc:
-                break
-
-        coin_amount = btc / order['Rate']
-        return order['Rate'], coin_amount
+        book = OrderBook.from_response(exchange.returnSellOrderBook(mkt))
+        rate, coin_amount = book.fill(btc)
+        return F(rate), F(coin_amount)
 
     def btc(self, exchange):
         b = exchange.returnBalance('BTC')
@@ -146,20 +354,32 @@ class TradePad(object):
         logging.debug("BAL: %s", b)
         return b
 
-    def execute(self):
+    def execute(self, exchange=None):
         exchange_name = 'bittrex'
-        exchange = _exchange.exchangeFactory(exchange_name, self.config)
-        for market, btc_to_spend in self.config.items(exchange_name):
+        if exchange is None:
+            exchange = _exchange.exchangeFactory(exchange_name, self.config)
+
+        def place(order):
+            market, btc_to_spend = order
             rate, amount = self.rate_for(exchange, market, btc_to_spend)
             exchange.buy(market, rate, amount)
+            return rate, amount
+
+        orders = [
+            (market, float(btc_to_spend))
+            for market, btc_to_spend in self.settings.buys(exchange_name).items()
+        ]
+        outcomes = pool.parallel_map(place, orders, workers=exchange.workers)
+        logging.debug("Execution summary:\n%s", execution_summary(outcomes))
+        return outcomes
 
     @property
     def pairs(self):
 
         pairs = dict()
 
-        for pair in self.config.get('pairs', 'pairs').split():
-            logging.debug("pair: {}".format(pair))
+        for pair in self.settings.pairs:
+            logging.debug("pair: %s", pair)
             pairs[pair] = self.exchange.tickerFor(pair)
 
         return pairs
@@ -170,12 +390,13 @@ class TradePad(object):
 
     def midpoint(self, pair):
         pair_info = self.exchange.tickerFor(pair)
-        logging.debug("Pair info in Midpoint = {}".format(pair_info))
+        logging.debug("Pair info in Midpoint = %s", pair_info)
         return (F(pair_info.lowestAsk) + F(pair_info.highestBid))/ 2.0
 
     def config_core(self):
         pass
 
+    @metrics.timed('tradepad.build_new_grids')
     def build_new_grids(self):
 
         grid = dict()
@@ -193,12 +414,12 @@ class TradePad(object):
                 gridtrader=self
             )
             for direction in 'sell buy'.split():
-                logging.debug(
-                   "{0} grid = {1}".format(direction, grid[pair][direction]))
+                logging.debug("%s grid = %s", direction, grid[pair][direction])
 
 
         self.grids = grid
 
+    @metrics.timed('tradepad.issue_trades')
     def issue_trades(self):
         for market in self.grids:
             self.market[market] = {
@@ -209,110 +430,211 @@ class TradePad(object):
                 g = self.grids[market][buysell]
 
                 if buysell in 'buy sell':
-                    try:
-                        g.place_orders(self.exchange)
-                    except (exception.NotEnoughCoin, exception.DustTrade):
-                        logging.debug("%s grid not fully created because there was not enough coin", buysell)
+                    self.place_grid(g)
                 else:
                     raise exception.InvalidDictionaryKey("Key other than buy or sell: %s", buysell)
 
 
+    def place_grid(self, grid):
+        "Place a grid's orders, keeping the levels placed if the exchange refuses one."
+        try:
+            grid.place_orders(self.exchange)
+        except (exception.NotEnoughCoin, exception.DustTrade) as e:
+            logging.debug(
+                "%s %s grid not fully created, %d levels placed: %s",
+                grid.pair, grid.side, len(grid), e)
+        return grid
+
+    @metrics.timed('tradepad.poll')
     def poll(self):
 
+        detector = FillDetector(self.exchange)
+        activity = detector.scan(self.grids)
+        self.prune_profit(self.grids, detector.open_ids)
+
         for market in self.grids:
-            logging.debug("Analyzing %s. Our current holdings = %s", market, self.exchange.returnBalanceFromMarket(market))
+            self.poll_market(market, activity)
 
-            g = self.grids[market]
+    @metrics.timed('tradepad.poll_market')
+    def poll_market(self, market, activity):
+        """Act on one market's fills, as found by a FillDetector scan.
 
-            logging.debug("Checking %s buy activity", market)
-            deepest_i = g['buy'].trade_activity(self.exchange)
-            if deepest_i is None:
-                logging.debug(
-                    "No %s buy trade activity detected %s",
-                    market, i_range(g['buy'].trade_ids)
-                    )
-            else:
-                gb = g['buy']
-                logging.debug(
-                    "%s Buy trade activity detected at index %d of %d",
-                       market, deepest_i, len(gb.trade_ids)-1)
-                for i in xrange(deepest_i, -1, -1):
-                    fill_rate = gb.grid[i]
-                    logging.debug("Buy rate @i={0} == {1}".format(i, fill_rate))
-                    logging.debug("Let's see our holdings %s", self.exchange.returnBalanceFromMarket(market))
-
-
-                    profit_target = gb.profitTarget
-                    if profit_target <= 0:
-                        logging.debug("Accumulating purchase instead of selling for profit")
-                    else:
-                        sell_rate = delta_by_percent(fill_rate, profit_target)
-                        logging.debug(
-                            "Creating sell trade size={0} rate={1}".format(
-                                gb.size, sell_rate))
-                        self.exchange.sell(market, amount=gb.size, rate=sell_rate)
-
-                gb.purge_closed_trades(deepest_i)
-
-                if not gb.trade_ids:
-                    logging.debug(
-                        """
-%s Buy grid exhausted. Creating new buy grid.
-Current market conditions: highestBid = %f, lowestAsk = %f
-                        """,
-                        market,
-                        self.exchange.tickerFor(market).highestBid,
-                        self.exchange.tickerFor(market).lowestAsk
-                    )
-                    deepest_filled_rate = self.exchange.tickerFor(market).highestBid
-                    self.grids[market]['buy'] = BuyGrid(
-                        pair=market,
-                        current_market_price=deepest_filled_rate,
-                        gridtrader=self
-                    ).place_orders(self.exchange)
-
-            logging.debug("Checking %s sell activity", market)
-            deepest_i = g['sell'].trade_activity(self.exchange)
-            if deepest_i is None:
-                logging.debug(
-                    "No %s sell trade activity detected %s",
-                    market, i_range(g['sell'].trade_ids)
-                )
-            else:
-                logging.debug(
-                    "%s Sell trade activity detected at index %d of %d",
-                    market, deepest_i, len(g['sell'].trade_ids)-1)
+        Returns True when either side of the market had trade activity.
+        """
+        if self.stuck.get(market):
+            self.cancel_buys(market, self.stuck.pop(market))
 
-                deepest_filled_rate = g['sell'].grid[deepest_i]
-                logging.debug("Deepest filled rate = %f", deepest_filled_rate)
+        quiet = activity[market, 'buy'] is None and activity[market, 'sell'] is None
+        if quiet and len(self.grids[market]['sell']):
+            logging.debug("No %s trade activity", market)
+            return False
 
-                g['sell'].purge_closed_trades(deepest_i)
+        logging.debug("Analyzing %s. Our current holdings = %s", market, self.exchange.returnBalanceFromMarket(market))
 
+        g = self.grids[market]
+
+        logging.debug("Checking %s buy activity", market)
+        deepest_i = activity[market, 'buy']
+        if deepest_i is None:
+            logging.debug(
+                "No %s buy trade activity detected %s",
+                market, i_range(g['buy'].trade_ids)
+                )
+        else:
+            gb = g['buy']
+            logging.debug(
+                "%s Buy trade activity detected at index %d of %d",
+                   market, deepest_i, len(gb)-1)
+            for i in xrange(deepest_i, -1, -1):
+                logging.debug("Buy rate @i=%s == %s", i, gb.rate(i))
+                self.buy_filled(
+                    market, gb.rate(i), gb.size_at(i), gb.profitTarget)
+
+            gb.purge_closed_trades(deepest_i)
+
+            if not len(gb):
                 logging.debug(
-                    "Cancelling and elevating the %s buy grid", market)
-                self.exchange.cancelOrders(
-                    self.grids[market]['buy'].trade_ids)
-                self.grids[market]['buy'] = BuyGrid(
+                    """
+%s Buy grid exhausted. Creating new buy grid.
+Current market conditions: highestBid = %f, lowestAsk = %f
+                    """,
+                    market,
+                    self.exchange.tickerFor(market).highestBid,
+                    self.exchange.tickerFor(market).lowestAsk
+                )
+                deepest_filled_rate = self.exchange.tickerFor(market).highestBid
+                self.grids[market]['buy'] = self.place_grid(BuyGrid(
                     pair=market,
                     current_market_price=deepest_filled_rate,
                     gridtrader=self
-                ).place_orders(self.exchange)
+                ))
+
+        logging.debug("Checking %s sell activity", market)
+        deepest_i = activity[market, 'sell']
+        if deepest_i is None:
+            logging.debug(
+                "No %s sell trade activity detected %s",
+                market, i_range(g['sell'].trade_ids)
+            )
+        else:
+            logging.debug(
+                "%s Sell trade activity detected at index %d of %d",
+                market, deepest_i, len(g['sell'])-1)
+
+            deepest_filled_rate = g['sell'].rate(deepest_i)
+            logging.debug("Deepest filled rate = %f", deepest_filled_rate)
+            for i in xrange(deepest_i + 1):
+                self.exchange.recordFill(
+                    market, 'sell', g['sell'].rate(i), g['sell'].size_at(i))
+
+            g['sell'].purge_closed_trades(deepest_i)
+
+            logging.debug(
+                "Cancelling and elevating the %s buy grid", market)
+            gb = self.grids[market]['buy']
+            self.cancel_buys(market, dict(
+                (gb.trade_id(i), (gb.rate(i), gb.size_at(i), gb.profitTarget))
+                for i in range(len(gb)) if gb.trade_id(i) is not None
+            ))
+            self.grids[market]['buy'] = self.place_grid(BuyGrid(
+                pair=market,
+                current_market_price=deepest_filled_rate,
+                gridtrader=self
+            ))
+
+        if not len(g['sell']):
+            logging.debug(
+                "%s Sell grid exhausted. Creating new sell grid",
+                market)
+            deepest_filled_rate = self.exchange.tickerFor(market).lowestAsk
+            g['sell'] = self.place_grid(SellGrid(
+                pair=market,
+                current_market_price=deepest_filled_rate,
+                gridtrader=self
+            ))
+
+        self.save(market)
+        return not quiet
+
+    def buy_filled(self, market, rate, amount, profit_target):
+        "Record a buy fill and place its profit-taking sell."
+        self.exchange.recordFill(market, 'buy', rate, amount)
+        logging.debug("Let's see our holdings %s", self.exchange.returnBalanceFromMarket(market))
+
+        if profit_target <= 0:
+            logging.debug("Accumulating purchase instead of selling for profit")
+            return
+        sell_rate = delta_by_percent(rate, profit_target)
+        logging.debug(
+            "Creating sell trade size=%s rate=%s", amount, sell_rate)
+        try:
+            r = self.exchange.sell(market, amount=amount, rate=sell_rate)
+            self.profit.setdefault(market, list()).append(r.orderNumber)
+        except (exception.NotEnoughCoin, exception.DustTrade) as e:
+            logging.debug(
+                "Profit-taking sell for %s not placed: %s", market, e)
+
+    def cancel_buys(self, market, orders):
+        """Cancel buy orders, given as {id: (rate, amount, profitTarget)}.
+
+        An order the exchange says is no longer open, and does not list
+        as cancelled, filled before the cancel reached it: its fill is
+        recorded and its profit-taking sell placed. Orders whose cancel
+        failed otherwise are kept in self.stuck and tried again on the
+        market's next poll, so none is left open and untracked.
+        """
+        outcomes = self.exchange.cancelOrders(list(orders))
+        not_open = [
+            trade_id for trade_id, outcome in outcomes.items()
+            if isinstance(outcome, exception.OrderNotOpen)
+        ]
+        stuck = dict(
+            (trade_id, orders[trade_id])
+            for trade_id, outcome in outcomes.items()
+            if outcome is not True and trade_id not in not_open
+        )
 
-            if not g['sell'].trade_ids:
+        if not_open:
+            cancelled = self.exchange.cancelledOrderIds()
+            for trade_id in not_open:
+                if trade_id in cancelled:
+                    continue
                 logging.debug(
-                    "%s Sell grid exhausted. Creating new sell grid",
-                    market)
-                deepest_filled_rate = self.exchange.tickerFor(market).lowestAsk
-                g['sell'] = SellGrid(
-                    pair=market,
-                    current_market_price=deepest_filled_rate,
-                    gridtrader=self
-                ).place_orders(self.exchange)
+                    "%s buy %s filled before it could be cancelled",
+                    market, trade_id)
+                self.buy_filled(market, *orders[trade_id])
+        if stuck:
+            logging.debug(
+                "Could not cancel %s buy orders, retrying next poll: %s",
+                market, dict((i, outcomes[i]) for i in stuck))
+            self.stuck.setdefault(market, dict()).update(stuck)
 
     def notify_admin(self, error_msg):
-
+        "Queue an error for the admin's next digest mail, if [email] is configured."
         import mymailer
-        mymailer.send_email(self.account, error_msg)
+        notifier = mymailer.from_config(self.config)
+        if notifier is None:
+            logging.debug("No [email] section; not mailing: %s", error_msg)
+            return
+        notifier.notify(self.account, error_msg)
+
+
+def execution_summary(outcomes):
+    from tabulate import tabulate
+    rows = list()
+    for o in outcomes:
+        market, btc_to_spend = o.item
+        if o.ok:
+            rate, amount = o.result
+            rows.append([market, btc_to_spend, 'ok', rate, amount, ''])
+        else:
+            rows.append([market, btc_to_spend, 'FAILED', '', '', o.error])
+
+    failed = len([o for o in outcomes if not o.ok])
+    table = tabulate(
+        rows, headers=['market', 'btc', 'status', 'rate', 'amount', 'error'])
+    return "{0}\n{1} placed, {2} failed".format(
+        table, len(outcomes) - failed, failed)
 
 
 def delta(percent, v):
@@ -324,7 +646,10 @@ def pdict(d, skip_false=True):
     for k in sorted(d.keys()):
         if not d[k] and skip_false:
             continue
-        parms.append("{0}={1}".format(k, d[k]))
+        v = d[k]
+        if isinstance(v, list):
+            v = '+'.join(v)
+        parms.append("{0}={1}".format(k, v))
 
     return ",".join(parms)
 
@@ -337,7 +662,10 @@ def iszero(v):
     # return isclose(0, v)
     return v < epsilon
 
-def get_balances(e):
+def get_balances(e, fresh=False):
+    "Positive balances from the facade's snapshot, reconciled first if fresh."
+    if fresh:
+        e.balances.invalidate()
 
     b = e.returnPositiveBalances()
 
@@ -345,59 +673,195 @@ def get_balances(e):
 
 def print_balances(e):
     b = get_balances(e)
-    logging.debug(b.pformat())
+    logging.debug("%s", mylogging.pretty(b))
 
 
 def initialize_logging(account_name, args):
 
     args = pdict(args)
 
-    rootLogger = logging.getLogger()
-
     logPath = 'log/{}'.format(account_name)
     fileName = "{0}--{1}".format(
         time.strftime("%Y%m%d-%H %M %S"),
         args
         )
 
-    fileHandler = logging.FileHandler(
-        "{0}/{1}.log".format(logPath, fileName))
-    #fileHandler.setFormatter(logFormatter)
-    rootLogger.addHandler(fileHandler)
-
-    consoleHandler = logging.StreamHandler(stream=sys.stdout)
-    #consoleHandler.setFormatter(logFormatter)
-    rootLogger.addHandler(consoleHandler)
+    mylogging.start("{0}/{1}.log".format(logPath, fileName))
 
     return args, fileName
 
-def main_init(exchange, gt, persistence_file):
-    exchange.cancelAllOpen()
-
-    logging.debug("Building trade grids")
-    gt.build_new_grids()
-
-    logging.debug("Issuing trades on created grids", 1)
-    gt.issue_trades()
+def main_init(exchange, gt, persistence_file, warm=False):
+    """Cancel everything and issue fresh grids or, if warm and grids were
+    persisted, reconcile those with the orders still open."""
+    persist = Persist(persistence_file)
+    state = persist.load() if warm else None
 
-    logging.debug("Storing GridTrader to disk.")
-    Persist(persistence_file).store(gt)
-
-@arg('account', help="The account whose API keys we are using (e.g. terrence, joseph, peter, etc.")
+    if state:
+        logging.debug("Resuming persisted grids")
+        gt.reconcile(state)
+    else:
+        exchange.cancelAllOpen()
+
+        logging.debug("Building trade grids")
+        gt.build_new_grids()
+
+        logging.debug("Issuing trades on created grids")
+        gt.issue_trades()
+
+    logging.debug("Storing grid state to disk.")
+    gt.persist = persist
+    gt.persist.store(gt)
+
+def start_service(tp, persistence_file, warm=False):
+    "Issue tp's grids on its exchange and return the scheduler that will poll them."
+    if tp.exchange.stream is None:
+        tp.exchange.attach_stream(stream.from_config(tp.exchange, tp.config))
+    main_init(tp.exchange, tp, persistence_file, warm)
+    if tp.account is not None:
+        tp.watch(config_file_name(tp.account), reload_interval(tp.config))
+    return MarketScheduler.from_config(tp)
+
+def run_service(tp, exchange_name='bittrex', warm=False):
+    "Build and issue grids, then poll them until interrupted."
+    snapshots = metrics.from_config(tp.config)
+    tp.exchange = _exchange.exchangeFactory(exchange_name, tp.config)
+    scheduler = start_service(
+        tp, persistence_file_name(exchange_name, tp.account), warm)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        logging.debug("Scheduler stopped: %s", scheduler.status())
+        stop_notifiers()
+        if snapshots is not None:
+            snapshots.stop()
+
+
+def stop_notifiers():
+    "Send the admin's pending error digests before the process exits."
+    import mymailer
+    mymailer.stop_all()
+
+
+def load_account(account):
+    "A TradePad with its own config for one account."
+    config = ConfigParser.RawConfigParser()
+    config.read(config_file_name(account))
+
+    return TradePad(config, account=account)
+
+def connect_accounts(tradepads, exchange_name='bittrex'):
+    """Give every TradePad its own exchange facade: its own keys, rate
+    limiter and orders. Market data is not private, so all of them read
+    tickers through one shared cache and one stream of all their pairs,
+    set up by the first account's [stream] section.
+
+    The exchange client module is shared as well, so accounts whose
+    [transport] settings differ are refused.
+    """
+    if exchange_name != 'sim':
+        import transport
+        if len(set(transport.settings(tp.config) for tp in tradepads)) > 1:
+            raise ValueError(
+                "Accounts on {0} must have the same [transport] settings".format(
+                    exchange_name))
+
+    tickers = None
+    for tp in tradepads:
+        tp.exchange = _exchange.exchangeFactory(
+            exchange_name, tp.config, tickers=tickers)
+        tickers = tp.exchange.tickers
+
+    markets = sorted(set(
+        market for tp in tradepads
+        for market in tp.config.get('pairs', 'pairs').split()))
+    market_data = stream.from_config(
+        tradepads[0].exchange, tradepads[0].config, markets)
+    for tp in tradepads:
+        tp.exchange.attach_stream(market_data)
+
+def account_summary(outcomes):
+    from tabulate import tabulate
+    rows = list()
+    for o in outcomes:
+        if not o.ok:
+            rows.append([o.item.account, '', '', o.error])
+            continue
+        failed = len([order for order in o.result if not order.ok])
+        rows.append([o.item.account, len(o.result) - failed, failed, ''])
+    return tabulate(rows, headers=['account', 'placed', 'failed', 'error'])
+
+def run_accounts(tradepads, exchange_name='bittrex'):
+    "Execute every account's buys concurrently and return an Outcome per account."
+    connect_accounts(tradepads, exchange_name)
+    outcomes = pool.parallel_map(
+        lambda tp: tp.execute(tp.exchange), tradepads, len(tradepads))
+    logging.debug("Accounts summary:\n%s", account_summary(outcomes))
+    return outcomes
+
+def serve_accounts(tradepads, exchange_name='bittrex', warm=False):
+    """Run a MarketScheduler per account on its own thread until interrupted,
+    or until every scheduler thread has ended.
+
+    An account whose grids cannot be issued is logged and left out; the
+    others carry on.
+    """
+    snapshots = metrics.from_config(tradepads[0].config)
+    connect_accounts(tradepads, exchange_name)
+
+    outcomes = pool.parallel_map(
+        lambda tp: start_service(
+            tp, persistence_file_name(exchange_name, tp.account), warm),
+        tradepads, len(tradepads))
+
+    schedulers, threads = dict(), list()
+    for o in outcomes:
+        if not o.ok:
+            logging.debug("Account %s not started: %s", o.item.account, o.trace)
+            continue
+        schedulers[o.item.account] = o.result
+        thread = threading.Thread(target=o.result.run, name=o.item.account)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for account in sorted(schedulers):
+            schedulers[account].stop()
+        stop_notifiers()
+    for account in sorted(schedulers):
+        logging.debug(
+            "Scheduler for %s stopped: %s",
+            account, schedulers[account].status())
+    if snapshots is not None:
+        snapshots.stop()
+
+
+@arg('accounts', nargs='+', help="The accounts whose API keys we are using (e.g. terrence, joseph, peter, etc.")
+@arg('--serve', help="Run grids as a service instead of buying once")
+@arg('--warm', help="With --serve, resume persisted grids and keep their open orders")
 def main(
-        account,
+        accounts,
+        serve=False,
+        warm=False,
 ):
 
     command_line_args = locals()
 
-    args, fileName = initialize_logging(account, command_line_args)
+    args, fileName = initialize_logging('+'.join(accounts), command_line_args)
 
-    config_file = config_file_name(account)
-    config = ConfigParser.RawConfigParser()
-    config.read(config_file)
-
-    tp = TradePad(config)
-    tp.execute()
+    tradepads = [load_account(account) for account in accounts]
+    if len(tradepads) > 1:
+        if serve:
+            serve_accounts(tradepads, warm=warm)
+        else:
+            run_accounts(tradepads)
+    elif serve:
+        run_service(tradepads[0], warm=warm)
+    else:
+        tradepads[0].execute()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,206 @@
+# core
+import functools
+import json
+import os
+import threading
+import time
+import types
+
+
+# Instrumentation costs one global lookup per call while this is False.
+enabled = False
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    "Latency counts in fixed buckets, Prometheus style."
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += seconds
+        self.count += 1
+
+    def cumulative(self):
+        "[(upper bound, observations at or below it), ...] ending with +Inf."
+        running, rows = 0, list()
+        for bound, n in zip(BUCKETS + (float('inf'),), self.counts):
+            running += n
+            rows.append((bound, running))
+        return rows
+
+
+class Registry(object):
+    """Call counts, latency histograms, errors by exception class and bytes received."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.latency = dict()
+        self.errors = dict()
+        self.bytes_received = dict()
+
+    def observe(self, name, seconds, error=None):
+        with self.lock:
+            histogram = self.latency.get(name)
+            if histogram is None:
+                histogram = self.latency[name] = Histogram()
+            histogram.observe(seconds)
+            if error is not None:
+                key = (name, type(error).__name__)
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def received(self, host, n):
+        with self.lock:
+            self.bytes_received[host] = self.bytes_received.get(host, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            return dict(
+                time=time.time(),
+                calls=dict(
+                    (name, dict(count=h.count, seconds=h.total,
+                                buckets=[[str(b), n] for b, n in h.cumulative()]))
+                    for name, h in self.latency.items()
+                ),
+                errors=[
+                    dict(call=name, error=error, count=n)
+                    for (name, error), n in sorted(self.errors.items())
+                ],
+                bytes_received=dict(self.bytes_received),
+            )
+
+    def prometheus(self):
+        "The registry as Prometheus text exposition format."
+        lines = list()
+        with self.lock:
+            lines.append('# TYPE gridtrader_call_seconds histogram')
+            for name in sorted(self.latency):
+                h = self.latency[name]
+                for bound, n in h.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(
+                        'gridtrader_call_seconds_bucket{{call="{0}",le="{1}"}} {2}'
+                        .format(name, le, n))
+                lines.append('gridtrader_call_seconds_sum{{call="{0}"}} {1!r}'
+                             .format(name, h.total))
+                lines.append('gridtrader_call_seconds_count{{call="{0}"}} {1}'
+                             .format(name, h.count))
+
+            lines.append('# TYPE gridtrader_call_errors_total counter')
+            for (name, error), n in sorted(self.errors.items()):
+                lines.append(
+                    'gridtrader_call_errors_total{{call="{0}",error="{1}"}} {2}'
+                    .format(name, error, n))
+
+            lines.append('# TYPE gridtrader_received_bytes_total counter')
+            for host, n in sorted(self.bytes_received.items()):
+                lines.append(
+                    'gridtrader_received_bytes_total{{host="{0}"}} {1}'
+                    .format(host, n))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def timed(name):
+    "Record the latency and any exception of every call while metrics are enabled."
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                registry.observe(name, time.time() - start, e)
+                raise
+            registry.observe(name, time.time() - start)
+            return result
+
+        wrapper.instrumented = True
+        return wrapper
+
+    return decorate
+
+
+def instrument(cls, prefix):
+    "Time every public method cls defines or inherits, as prefix.method."
+    for klass in cls.__mro__:
+        if klass is object:
+            continue
+        for name, value in list(vars(klass).items()):
+            if name.startswith('_') or not isinstance(value, types.FunctionType):
+                continue
+            if getattr(value, 'instrumented', False):
+                continue
+            setattr(klass, name, timed('{0}.{1}'.format(prefix, name))(value))
+    return cls
+
+
+class Snapshotter(object):
+    """Write the registry to disk every `interval` seconds.
+
+    A path ending in .prom gets the Prometheus text format, anything else
+    JSON. Files are replaced atomically, so readers never see half of one.
+    """
+
+    def __init__(self, path, interval=60.0):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def write(self):
+        if self.path.endswith('.prom'):
+            data = registry.prometheus()
+        else:
+            data = json.dumps(registry.snapshot(), sort_keys=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.rename(tmp, self.path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='metrics')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.write()
+
+
+def from_config(config):
+    "Enable metrics and start a Snapshotter if [metrics] asks for them."
+    global enabled
+    if not (config.has_option('metrics', 'enabled')
+            and config.getboolean('metrics', 'enabled')):
+        return None
+
+    enabled = True
+    if not config.has_option('metrics', 'path'):
+        return None
+
+    interval = 60.0
+    if config.has_option('metrics', 'interval'):
+        interval = config.getfloat('metrics', 'interval')
+    return Snapshotter(config.get('metrics', 'path'), interval).start()
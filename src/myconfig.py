@@ -0,0 +1,172 @@
+# core
+from collections import namedtuple
+import ConfigParser
+import logging
+import os
+import time
+
+# local
+from grid import pair2currency
+
+
+GRID_SECTIONS = (('sell', 'sellgrid'), ('buy', 'buygrid'))
+
+# Exchange sections listing the BTC to spend per market when executing.
+BUY_SECTIONS = ('bittrex', 'polo')
+
+GridSettings = namedtuple(
+    'GridSettings',
+    'majorLevel increments numberOfOrders size profitTarget')
+
+
+class Settings(object):
+    """An account config parsed once into typed values.
+
+    Pairs, core positions, grid sections and buy lists are read when the
+    Settings is made, not on every access. `parser` is the RawConfigParser
+    they came from, for the sections read ad hoc. ConfigParser lowercases
+    option names, so market and currency names taken from option names
+    are put back in upper case.
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+
+        self.pairs = list()
+        if parser.has_option('pairs', 'pairs'):
+            self.pairs = parser.get('pairs', 'pairs').split()
+
+        self.core_positions = dict()
+        if parser.has_section('initialcorepositions'):
+            self.core_positions = dict(
+                (currency.upper(), float(amount))
+                for currency, amount in parser.items('initialcorepositions'))
+
+        self.grids = dict()
+        for _, section in GRID_SECTIONS:
+            if not parser.has_section(section):
+                continue
+            profit_target = 0
+            if parser.has_option(section, 'profitTarget'):
+                profit_target = parser.getfloat(section, 'profitTarget')
+            self.grids[section] = GridSettings(
+                majorLevel=parser.getfloat(section, 'majorLevel'),
+                increments=parser.getfloat(section, 'increments'),
+                numberOfOrders=parser.getint(section, 'numberOfOrders'),
+                size=parser.getfloat(section, 'size'),
+                profitTarget=profit_target,
+            )
+
+        self._buys = dict(
+            (section, dict(
+                (market.upper(), float(btc))
+                for market, btc in parser.items(section)))
+            for section in BUY_SECTIONS if parser.has_section(section)
+        )
+
+    def buys(self, exchange_name):
+        "{market: BTC to spend} from the exchange's section."
+        return dict(self._buys.get(exchange_name, ()))
+
+    def grid_parameters(self, section, pair):
+        """A grid section's parameters for pair, sizing orders from its core position.
+
+        Raises KeyError when the section or the pair's core position is missing.
+        """
+        g = self.grids[section]
+        core_position = self.core_positions[pair2currency(pair).upper()]
+        return dict(
+            majorLevel=g.majorLevel,
+            increments=g.increments,
+            numberOfOrders=g.numberOfOrders,
+            size=g.size * core_position / 100.0 / g.numberOfOrders,
+            profitTarget=g.profitTarget,
+        )
+
+
+def load(path):
+    parser = ConfigParser.RawConfigParser()
+    if not parser.read(path):
+        raise IOError("cannot read config file {0}".format(path))
+    return Settings(parser)
+
+
+class Changes(namedtuple('Changes', 'added removed regrid')):
+    "Pairs added and removed, and {market: [sides]} whose grid parameters changed."
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.regrid)
+
+
+def diff(old, new):
+    "The grid work needed to go from old Settings to new."
+    old_pairs, new_pairs = set(old.pairs), set(new.pairs)
+
+    def parameters(settings, section, market):
+        try:
+            return settings.grid_parameters(section, market)
+        except KeyError:
+            return None
+
+    regrid = dict()
+    for market in sorted(old_pairs & new_pairs):
+        sides = [
+            side for side, section in GRID_SECTIONS
+            if parameters(old, section, market) != parameters(new, section, market)
+        ]
+        if sides:
+            regrid[market] = sides
+
+    return Changes(
+        added=sorted(new_pairs - old_pairs),
+        removed=sorted(old_pairs - new_pairs),
+        regrid=regrid,
+    )
+
+
+class ConfigWatcher(object):
+    """Notice when a config file changes and load the new version.
+
+    The file is looked at no more than every `interval` seconds, and a
+    change is only loaded once the file has stayed the same for one
+    interval, so a half-saved file is not acted on. A file that does not
+    parse is logged and skipped until it changes again.
+    """
+
+    def __init__(self, path, interval=10.0):
+        self.path = path
+        self.interval = interval
+        self.mtime = self._mtime()
+        self.pending = self.mtime
+        self.checked = time.time()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def poll(self):
+        "New Settings if the file has changed and settled, otherwise None."
+        now = time.time()
+        if now - self.checked < self.interval:
+            return None
+        self.checked = now
+
+        mtime = self._mtime()
+        if mtime is None or mtime == self.mtime:
+            return None
+        if mtime != self.pending:
+            self.pending = mtime
+            return None
+
+        self.mtime = mtime
+        try:
+            return load(self.path)
+        except (ConfigParser.Error, IOError, ValueError) as e:
+            logging.debug("Ignoring unreadable config %s: %s", self.path, e)
+            return None
+
+    def retry(self):
+        "Load the file again at the next poll, as if it had just changed."
+        self.mtime = None
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# core
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import pprint
+import Queue
+import shutil
+import sys
+import threading
+
+
+class Lazy(object):
+    """Defer building a log argument until a handler formats the record.
+
+    logging.debug("R=%s", Lazy(pprint.pformat, r)) costs nothing when
+    debug records are dropped, and through a QueueHandler the formatting
+    happens on the writer thread rather than the trading thread. r is
+    shown as it is when the writer gets to it, so only wrap payloads no
+    one changes afterwards, such as a response just received.
+    """
+
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+def pretty(obj):
+    "A lazily pretty-printed payload."
+    return Lazy(pprint.pformat, obj)
+
+
+class QueueHandler(logging.Handler):
+    """Put records on a queue for a QueueListener, never waiting for it.
+
+    A record with a Lazy argument is queued with its arguments as they
+    are, to be formatted on the writer thread. Any other record's message
+    is formatted before it is queued, as the standard library's
+    QueueHandler.prepare does, since its arguments may be objects the
+    caller goes on changing. If the writer falls so far behind that the
+    queue is full, records are dropped and counted rather than stalling
+    the caller.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        "Replace the message, unless it has Lazy payloads, and traceback with their text."
+        args = record.args if isinstance(record.args, tuple) else ()
+        if not any(isinstance(arg, Lazy) for arg in args):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    "Drain a queue of records into handlers on a background thread."
+
+    _stop = object()
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._stop:
+                return
+            if record.args:
+                # Lazy payloads, formatted once here for every handler. If
+                # that fails, the handlers report it through handleError.
+                try:
+                    record.msg = record.getMessage()
+                    record.args = None
+                except Exception:
+                    pass
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.queue.put(self._stop)
+        self.thread.join()
+        self.thread = None
+        for handler in self.handlers:
+            handler.close()
+
+
+class JSONFormatter(logging.Formatter):
+    "One JSON object per record: time, level, logger, thread and message."
+
+    def format(self, record):
+        entry = dict(
+            time=self.formatTime(record),
+            level=record.levelname,
+            logger=record.name,
+            thread=record.threadName,
+            message=record.getMessage(),
+        )
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    "A RotatingFileHandler whose rotated files are gzipped: name.1.gz, name.2.gz..."
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        for i in range(self.backupCount - 1, 0, -1):
+            source = "{0}.{1}.gz".format(self.baseFilename, i)
+            if os.path.exists(source):
+                os.rename(source, "{0}.{1}.gz".format(self.baseFilename, i + 1))
+
+        if os.path.exists(self.baseFilename):
+            with open(self.baseFilename, 'rb') as plain:
+                with gzip.open(self.baseFilename + '.1.gz', 'wb') as packed:
+                    shutil.copyfileobj(plain, packed)
+            os.remove(self.baseFilename)
+
+        self.stream = self._open()
+
+
+def start(path, level=logging.DEBUG, max_bytes=50 * 1024 * 1024, backups=5,
+          console=True, queue_size=100000):
+    """Route the root logger through a queue to a background writer.
+
+    The writer appends JSON records to path, rotating and gzipping it
+    every max_bytes, and echoes plain text to stdout if console is set.
+    The directory holding path is created if need be. The queue is
+    flushed at interpreter exit. Returns the QueueListener.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    file_handler = CompressingRotatingFileHandler(
+        path, maxBytes=max_bytes, backupCount=backups)
+    file_handler.setFormatter(JSONFormatter())
+    handlers = [file_handler]
+
+    if console:
+        handlers.append(logging.StreamHandler(stream=sys.stdout))
+
+    queue = Queue.Queue(queue_size)
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(queue))
+    root.setLevel(level)
+
+    listener = QueueListener(queue, *handlers).start()
+    atexit.register(listener.stop)
+    return listener
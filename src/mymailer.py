@@ -1,37 +1,226 @@
+# core
+import atexit
+from email.mime.text import MIMEText
 import logging
+import Queue
+import smtplib
+import socket
+import threading
+import time
 
-logging.basicConfig(level=logging.DEBUG)
 
-def _send_email(user, password, recipient, subject, body):
-    import smtplib
+class SMTPConnection(object):
+    """One SMTP session, opened on first use and kept for later messages.
 
-    gmail_user = user
-    gmail_pwd = password
-    FROM = user
-    TO = recipient if type(recipient) is list else [recipient]
-    SUBJECT = subject
-    TEXT = body
+    A session the server has dropped is reopened once before giving up.
+    STARTTLS and login are only done when configured, so a plain local
+    SMTP server can stand in for the real one.
+    """
 
-    # Prepare actual message
-    message = """From: %s\nTo: %s\nSubject: %s\n\n%s
-    """ % (FROM, ", ".join(TO), SUBJECT, TEXT)
-    try:
-        server = smtplib.SMTP("smtp.gmail.com", 587)
+    def __init__(self, host, port=25, user=None, password=None,
+                 starttls=False, timeout=30):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.server = None
+
+    def connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
         server.ehlo()
-        server.starttls()
-        server.login(gmail_user, gmail_pwd)
-        server.sendmail(FROM, TO, message)
-        server.close()
-        logging.debug('successfully sent the mail')
-    except Exception as e:
-        logging.debug('failed to send mail %s', e)
-
-
-def send_email(account, body):
-    _send_email(
-        'terrence.brannon@gmail.com',
-        'serca972Yancey!',
-        'terrence.brannon@gmail.com',
-        '({}) ADSactly Grid Trader Error'.format(account),
-        body
+        if self.starttls:
+            server.starttls()
+            server.ehlo()
+        if self.user:
+            server.login(self.user, self.password)
+        self.server = server
+
+    def send(self, sender, recipients, message):
+        for attempt in range(2):
+            if self.server is None:
+                self.connect()
+            try:
+                self.server.sendmail(sender, recipients, message)
+                return
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+        self.server = None
+
+
+class Notifier(object):
+    """Mail errors to the admin from a background thread, as digests.
+
+    notify() only queues the message, so callers on the trading path never
+    wait for SMTP. The worker collects messages for `window` seconds after
+    the first one arrives and sends them as one mail, with identical
+    messages from the same account counted rather than repeated. At most
+    one mail goes out per window. If the queue fills up, new messages are
+    dropped and counted in the next digest.
+    """
+
+    _stop = object()
+
+    def __init__(self, connection, sender, recipients, window=300.0,
+                 max_entries=50, queue_size=1000):
+        self.connection = connection
+        self.sender = sender
+        self.recipients = recipients
+        self.window = window
+        self.max_entries = max_entries
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.sent = 0
+        self.thread = None
+
+    def notify(self, account, text):
+        try:
+            self.queue.put_nowait((account, text, time.time()))
+        except Queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='notifier')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def collect(self):
+        """Wait for a message, then gather everything else that arrives
+        within the window. Returns (entries, stopping)."""
+        entries = dict()
+        item = self.queue.get()
+        deadline = time.time() + self.window
+        while item is not self._stop:
+            account, text, when = item
+            entry = entries.get((account, text))
+            if entry is None:
+                entries[account, text] = entry = dict(count=0, first=when)
+            entry['count'] += 1
+            entry['last'] = when
+
+            wait = deadline - time.time()
+            if wait <= 0:
+                return entries, False
+            try:
+                item = self.queue.get(timeout=wait)
+            except Queue.Empty:
+                return entries, False
+        return entries, True
+
+    def run(self):
+        while True:
+            entries, stopping = self.collect()
+            if entries or self.dropped:
+                self.send_digest(entries)
+            if stopping:
+                self.connection.close()
+                return
+
+    def digest(self, entries):
+        "The (subject, body) of one mail covering entries."
+        accounts = sorted(set(account for account, _ in entries))
+        total = sum(entry['count'] for entry in entries.values())
+        subject = '({0}) ADSactly Grid Trader Error{1}'.format(
+            ', '.join(str(a) for a in accounts), 's' if total > 1 else '')
+
+        ordered = sorted(entries.items(), key=lambda item: item[1]['first'])
+        parts = list()
+        for (account, text), entry in ordered[:self.max_entries]:
+            parts.append('[{0}] x{1}, first at {2}, last at {3}\n{4}\n'.format(
+                account, entry['count'],
+                time.strftime('%H:%M:%S', time.localtime(entry['first'])),
+                time.strftime('%H:%M:%S', time.localtime(entry['last'])),
+                text))
+        if len(ordered) > self.max_entries:
+            parts.append('... and {0} other errors\n'.format(
+                len(ordered) - self.max_entries))
+        if self.dropped:
+            parts.append('{0} errors were dropped while the queue was full\n'
+                         .format(self.dropped))
+        return subject, '\n'.join(parts)
+
+    def send_digest(self, entries):
+        subject, body = self.digest(entries)
+        self.dropped = 0
+
+        message = MIMEText(body)
+        message['From'] = self.sender
+        message['To'] = ', '.join(self.recipients)
+        message['Subject'] = subject
+        try:
+            self.connection.send(
+                self.sender, self.recipients, message.as_string())
+            self.sent += 1
+            logging.debug('successfully sent the mail')
+        except Exception as e:
+            logging.debug('failed to send mail %s', e)
+
+    def stop(self):
+        "Send what is queued and close the connection."
+        if self.thread is None:
+            return
+        self.queue.put(self._stop)
+        self.thread.join()
+        self.thread = None
+
+
+_shared = dict()
+_shared_lock = threading.Lock()
+
+
+def from_config(config):
+    """The running Notifier for the [email] section, or None without one.
+
+    Accounts with the same mail settings share one Notifier and so one
+    SMTP connection. It is stopped at interpreter exit, so the errors
+    queued just before a crash are still sent.
+    """
+    if not config.has_section('email'):
+        return None
+
+    def option(name, default=None):
+        if config.has_option('email', name):
+            return config.get('email', name)
+        return default
+
+    settings = (
+        option('host', 'localhost'),
+        int(option('port', 25)),
+        option('user'),
+        option('password'),
+        option('starttls', 'false').lower() in ('1', 'yes', 'true', 'on'),
+        option('sender', option('user')),
+        tuple(option('recipient', '').split()),
+        float(option('window', 300)),
+        int(option('maxEntries', 50)),
     )
+    with _shared_lock:
+        if settings not in _shared:
+            host, port, user, password, starttls = settings[:5]
+            sender, recipients, window, max_entries = settings[5:]
+            notifier = Notifier(
+                SMTPConnection(host, port, user, password, starttls),
+                sender, list(recipients), window, max_entries).start()
+            atexit.register(notifier.stop)
+            _shared[settings] = notifier
+        return _shared[settings]
+
+
+def stop_all():
+    "Send what every shared Notifier has queued and stop them."
+    with _shared_lock:
+        notifiers = list(_shared.values())
+    for notifier in notifiers:
+        notifier.stop()
@@ -1,16 +1,178 @@
 # -*- coding: utf-8 -*-
 
-from sympy import N
-from sympy.core.numbers import Float
+# core
+from decimal import Decimal, ROUND_HALF_EVEN
 
-def mystr(f): return "{:.8f}".format(float(f))
-Float.__str__ = Float.__repr__ = mystr
+PLACES = 8
+SCALE = 10 ** PLACES
+
+
+def _div_round(n, d):
+    "n / d rounded half-to-even, in integers."
+    if d < 0:
+        n, d = -n, -d
+    q, r = divmod(n, d)
+    twice = 2 * r
+    if twice > d or (twice == d and q % 2):
+        q += 1
+    return q
+
+
+def _parse(text):
+    "Parse decimal text to 1e-8 units without going through Decimal."
+    text = text.strip()
+    if 'e' in text or 'E' in text:
+        d = Decimal(text) * SCALE
+        return int(d.to_integral_value(rounding=ROUND_HALF_EVEN))
+
+    negative = text.startswith('-')
+    whole, _, frac = text.lstrip('+-').partition('.')
+    units = int(whole or '0') * SCALE
+    if frac:
+        kept, rest = frac[:PLACES], frac[PLACES:]
+        units += int(kept.ljust(PLACES, '0'))
+        if rest.strip('0'):
+            half = '5'.ljust(len(rest), '0')
+            if rest > half or (rest == half and units % 2):
+                units += 1
+    return -units if negative else units
+
+
+def _units(n):
+    "Convert a number to an integer count of 1e-8 units."
+    if isinstance(n, Fixed):
+        return n.units
+    if isinstance(n, (int, long)):
+        return n * SCALE
+    if isinstance(n, float):
+        if n.is_integer():
+            return int(n) * SCALE
+        return _parse(repr(n))
+    if isinstance(n, basestring):
+        return _parse(n)
+    d = Decimal(n) * SCALE
+    return int(d.to_integral_value(rounding=ROUND_HALF_EVEN))
+
+
+class Fixed(object):
+    """A price or quantity with exactly 8 decimal places.
+
+    Values are held as integer satoshis, so addition and comparison are
+    exact and multiplication and division round half-to-even to 8 places.
+    Plain ints, floats and strings are converted on the way in.
+    """
+
+    __slots__ = ('units',)
+
+    def __init__(self, n=0):
+        self.units = _units(n)
+
+    @classmethod
+    def from_units(cls, units):
+        f = cls.__new__(cls)
+        f.units = units
+        return f
+
+    def decimal(self):
+        return Decimal(self.units).scaleb(-PLACES)
+
+    def __str__(self):
+        sign = '-' if self.units < 0 else ''
+        whole, frac = divmod(abs(self.units), SCALE)
+        return "{0}{1}.{2:08d}".format(sign, whole, frac)
+
+    __repr__ = __str__
+
+    def __format__(self, spec):
+        if not spec:
+            return str(self)
+        return format(self.decimal(), spec)
+
+    def __float__(self):
+        return self.units / float(SCALE)
+
+    def __int__(self):
+        whole = abs(self.units) // SCALE
+        return whole if self.units >= 0 else -whole
+
+    def __nonzero__(self):
+        return self.units != 0
+
+    __bool__ = __nonzero__
+
+    def __hash__(self):
+        # Equal to the hash of the int, float or Decimal it compares equal to.
+        return hash(self.decimal())
+
+    def __neg__(self):
+        return Fixed.from_units(-self.units)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return Fixed.from_units(abs(self.units))
+
+    def __add__(self, other):
+        return Fixed.from_units(self.units + _units(other))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return Fixed.from_units(self.units - _units(other))
+
+    def __rsub__(self, other):
+        return Fixed.from_units(_units(other) - self.units)
+
+    def __mul__(self, other):
+        if isinstance(other, (int, long)):
+            return Fixed.from_units(self.units * other)
+        return Fixed.from_units(_div_round(self.units * _units(other), SCALE))
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if isinstance(other, float) and other.is_integer():
+            other = int(other)
+        if isinstance(other, (int, long)):
+            return Fixed.from_units(_div_round(self.units, other))
+        return Fixed.from_units(_div_round(self.units * SCALE, _units(other)))
+
+    __div__ = __truediv__
+
+    def __rtruediv__(self, other):
+        return Fixed.from_units(_div_round(_units(other) * SCALE, self.units))
+
+    __rdiv__ = __rtruediv__
+
+    def __eq__(self, other):
+        try:
+            return self.units == _units(other)
+        except (TypeError, ValueError, ArithmeticError):
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __lt__(self, other):
+        return self.units < _units(other)
+
+    def __le__(self, other):
+        return self.units <= _units(other)
+
+    def __gt__(self, other):
+        return self.units > _units(other)
+
+    def __ge__(self, other):
+        return self.units >= _units(other)
 
 
 def F(n):
-    return N(n, 8)
+    return Fixed(n)
 
 
 def CF(config, config_section, config_parm):
     return F(config.getfloat(config_section, config_parm))
-
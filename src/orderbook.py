@@ -0,0 +1,86 @@
+# core
+from array import array
+from bisect import bisect_left
+
+# local
+import exception
+
+
+def levels(response, side):
+    """Yield (rate, quantity) pairs from an order book response.
+
+    Accepts a Bittrex one-sided book (a list of Rate/Quantity dicts), a
+    Bittrex two-sided book ({'buy': ..., 'sell': ...}) and a Poloniex book
+    ({'asks': [[rate, amount], ...], 'bids': ...}).
+    """
+    if isinstance(response, dict):
+        if side in response:
+            response = response[side]
+        else:
+            response = response['asks' if side == 'sell' else 'bids']
+
+    for order in response:
+        if isinstance(order, dict):
+            yield float(order['Rate']), float(order['Quantity'])
+        else:
+            yield float(order[0]), float(order[1])
+
+
+class OrderBook(object):
+    """One side of an order book, best price first, as array columns.
+
+    cost[i] is the BTC needed to take every order up to and including
+    level i, so the level that fills a budget is found by binary search.
+    """
+
+    def __init__(self, levels):
+        self.rates = array('d')
+        self.quantities = array('d')
+        self.cost = array('d')
+        self.filled = array('d')
+
+        cost = filled = 0.0
+        for rate, quantity in levels:
+            cost += rate * quantity
+            filled += quantity
+            self.rates.append(rate)
+            self.quantities.append(quantity)
+            self.cost.append(cost)
+            self.filled.append(filled)
+
+    @classmethod
+    def from_response(cls, response, side='sell'):
+        return cls(levels(response, side))
+
+    def __len__(self):
+        return len(self.rates)
+
+    @property
+    def depth(self):
+        "Total BTC it would take to clear this side of the book."
+        return self.cost[-1] if self.cost else 0.0
+
+    def fill(self, btc):
+        """Return the limit rate and coin quantity that spend btc.
+
+        The quantity counts everything taken at better prices plus the
+        part of the last level the remaining BTC buys.
+        """
+        i = bisect_left(self.cost, btc)
+        if i == len(self.cost):
+            raise exception.InsufficientLiquidity(
+                "{0} BTC exceeds book depth of {1} BTC".format(btc, self.depth))
+
+        spent = self.cost[i - 1] if i else 0.0
+        taken = self.filled[i - 1] if i else 0.0
+        rate = self.rates[i]
+        return rate, taken + (btc - spent) / rate
+
+    def vwap(self, btc):
+        "Average rate paid when spending btc against this book."
+        rate, quantity = self.fill(btc)
+        return btc / quantity
+
+    def fill_many(self, budgets):
+        "fill() for many BTC budgets against this one snapshot."
+        return [self.fill(btc) for btc in budgets]
@@ -0,0 +1,149 @@
+# core
+import json
+import logging
+import os
+import threading
+
+
+# The pseudo-side under which a market's profit-taking sell ids are kept.
+PROFIT = 'profit'
+
+
+def grid_state(grid):
+    """The part of a grid worth keeping: its levels, sizes and order ids.
+
+    A list, as kept under PROFIT, is stored as it is.
+    """
+    if isinstance(grid, list):
+        return list(grid)
+    return grid.to_state()
+
+
+def grids_state(grids):
+    return dict(
+        (market, dict(
+            (side, grid_state(grids[market][side])) for side in grids[market]
+        ))
+        for market in grids
+    )
+
+
+class Persist(object):
+    """Grid state on disk as a snapshot plus an append-only journal.
+
+    Only plain grid data is written: no config, no exchange handle, so
+    loading never needs a connection. Each journal line replaces the state
+    of one market side, which makes replaying it over the snapshot
+    idempotent. Snapshots are written to a temporary file and renamed
+    into place, so a crash mid-write leaves the previous one intact.
+
+    Every snapshot has a generation number, and journal lines carry the
+    generation they follow. If a crash comes after a snapshot is renamed
+    into place but before the journal is emptied, the old lines are
+    ignored rather than replayed over the newer snapshot.
+    """
+
+    def __init__(self, path, snapshot_every=500):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.snapshot_every = snapshot_every
+        self.journaled = 0
+        self.lock = threading.RLock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.generation = self.read_snapshot()[0]
+        self.repair()
+
+    def repair(self):
+        "Drop a journal line torn by a crash, so new entries start cleanly."
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+        self.journaled = data.count(b'\n')
+
+    def store(self, gt):
+        "Snapshot every grid of a TradePad and its profit-taking sell ids."
+        state = grids_state(gt.grids)
+        for market, ids in gt.profit.items():
+            if ids:
+                state.setdefault(market, dict())[PROFIT] = list(ids)
+        self.snapshot(state)
+
+    def snapshot(self, state):
+        tmp = self.path + '.tmp'
+        with self.lock:
+            generation = self.generation + 1
+            with open(tmp, 'w') as f:
+                json.dump(
+                    dict(generation=generation, grids=state), f,
+                    separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+            self.generation = generation
+
+            open(self.journal_path, 'w').close()
+            self.journaled = 0
+
+    def record(self, market, side, grid):
+        "Journal the new state of one side of a market; None removes it."
+        entry = dict(
+            market=market,
+            side=side,
+            state=None if grid is None else grid_state(grid),
+        )
+        with self.lock:
+            entry['generation'] = self.generation
+            with open(self.journal_path, 'a') as f:
+                f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.journaled += 1
+            if self.journaled >= self.snapshot_every:
+                self.snapshot(self.load())
+
+    def read_snapshot(self):
+        """(generation, state) from the snapshot file, (0, {}) without one.
+
+        A snapshot written before generations were kept is generation 0.
+        """
+        if not os.path.exists(self.path):
+            return 0, dict()
+        with open(self.path) as f:
+            data = json.load(f)
+        if 'generation' in data and 'grids' in data:
+            return data['generation'], data['grids']
+        return 0, data
+
+    def load(self):
+        "Return {market: {side: state}} from the snapshot and journal."
+        generation, state = self.read_snapshot()
+
+        if not os.path.exists(self.journal_path):
+            return state
+
+        with open(self.journal_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logging.debug("Ignoring torn journal line %r", line)
+                    continue
+                if entry.get('generation', 0) != generation:
+                    continue
+
+                sides = state.setdefault(entry['market'], dict())
+                if entry['state'] is None:
+                    sides.pop(entry['side'], None)
+                else:
+                    sides[entry['side']] = entry['state']
+                if not sides:
+                    del state[entry['market']]
+
+        return state
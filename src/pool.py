@@ -0,0 +1,68 @@
+# core
+import logging
+import threading
+import traceback
+
+
+class Outcome(object):
+    "The result of running one job: either a return value or an error."
+
+    def __init__(self, item, result=None, error=None, trace=None):
+        self.item = item
+        self.result = result
+        self.error = error
+        self.trace = trace
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            return "Outcome({0!r} -> {1!r})".format(self.item, self.result)
+        return "Outcome({0!r} failed: {1!r})".format(self.item, self.error)
+
+
+def _run(func, item):
+    try:
+        return Outcome(item, result=func(item))
+    except Exception as e:
+        logging.debug("Job for %s failed: %s", item, e)
+        return Outcome(item, error=e, trace=traceback.format_exc())
+
+
+def parallel_map(func, items, workers=8):
+    """Run func over items on a bounded set of threads.
+
+    Exceptions never escape: every item gets an Outcome, in input order.
+    Threads are started per call, so parallel_map may be nested.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    if workers <= 1 or len(items) == 1:
+        return [_run(func, item) for item in items]
+
+    outcomes = [None] * len(items)
+    pending = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                i = next(pending, None)
+            if i is None:
+                return
+            outcomes[i] = _run(func, items[i])
+
+    threads = [
+        threading.Thread(target=work)
+        for _ in range(min(workers, len(items)))
+    ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return outcomes
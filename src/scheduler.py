@@ -0,0 +1,192 @@
+# core
+import heapq
+import logging
+import threading
+import time
+import traceback
+
+# local
+from fills import FillDetector
+import pool
+
+
+def option(config, name, default):
+    if config.has_option('scheduler', name):
+        return config.getfloat('scheduler', name)
+    return default
+
+
+class MarketScheduler(object):
+    """Drive TradePad.poll_market as a long-running service.
+
+    Every market has its own polling interval. A market with fills is
+    polled twice as often, down to min_interval; a quiet one backs off by
+    `backoff` each time, up to max_interval. Markets that come due
+    together are polled concurrently on the exchange's thread pool, and
+    the facade's rate limiter keeps them within the request budget.
+    """
+
+    def __init__(self, tradepad, min_interval=5.0, max_interval=300.0,
+                 backoff=1.5):
+        self.tradepad = tradepad
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.intervals = dict()
+        # Queue entries are (when, market, generation); an entry from before
+        # a market was last added is stale and skipped.
+        self.generations = dict()
+        self.queue = list()
+        self.stopped = threading.Event()
+        self.metrics = dict(
+            cycles=0,
+            skipped=0,
+            errors=0,
+            queue_depth=0,
+            cycle_latency=0.0,
+            max_cycle_latency=0.0,
+            lag=0.0,
+        )
+
+        for market in tradepad.grids:
+            self.add(market)
+
+    @classmethod
+    def from_config(cls, tradepad):
+        config = tradepad.config
+        return cls(
+            tradepad,
+            min_interval=option(config, 'minInterval', 5.0),
+            max_interval=option(config, 'maxInterval', 300.0),
+            backoff=option(config, 'backoff', 1.5),
+        )
+
+    def add(self, market, delay=0):
+        self.intervals[market] = self.min_interval
+        self.generations[market] = self.generations.get(market, 0) + 1
+        self.push(market, delay)
+
+    def push(self, market, delay):
+        heapq.heappush(
+            self.queue,
+            (time.time() + delay, market, self.generations[market]))
+
+    def remove(self, market):
+        self.intervals.pop(market, None)
+
+    def due(self, now):
+        "Pop every market whose time has come, counting cycles it missed."
+        markets = list()
+        while self.queue and self.queue[0][0] <= now:
+            when, market, generation = heapq.heappop(self.queue)
+            if market not in self.intervals or market in markets:
+                continue
+            if generation != self.generations[market]:
+                continue
+            self.metrics['skipped'] += int((now - when) / self.intervals[market])
+            self.metrics['lag'] = max(self.metrics['lag'], now - when)
+            markets.append(market)
+        return markets
+
+    def adjust(self, market, active):
+        interval = self.intervals[market]
+        if active:
+            interval = max(self.min_interval, interval / 2.0)
+        else:
+            interval = min(self.max_interval, interval * self.backoff)
+        self.intervals[market] = interval
+        return interval
+
+    def reload(self):
+        "Apply config file changes, scheduling added markets and dropping removed ones."
+        changes = self.tradepad.reload()
+        if not changes:
+            return
+        for market in changes.removed:
+            self.remove(market)
+        for market in changes.added:
+            self.add(market)
+
+    def failed(self, what):
+        "Count, log and mail the exception being handled."
+        self.metrics['errors'] += 1
+        trace = traceback.format_exc()
+        logging.debug("%s failed: %s", what, trace)
+        self.tradepad.notify_admin("{0} failed:\n{1}".format(what, trace))
+
+    def requeue(self, market, active):
+        "Schedule a polled market again, after its adjusted interval."
+        if market not in self.intervals:
+            return
+        self.push(market, self.adjust(market, active))
+
+    def tick(self):
+        """Poll every due market once. Returns the markets polled.
+
+        If the fill scan fails, the due markets are put back, backed off
+        as if they were quiet, rather than lost.
+        """
+        try:
+            self.reload()
+        except Exception:
+            self.failed("Reloading the config")
+        start = time.time()
+        self.metrics['lag'] = 0.0
+        markets = self.due(start)
+        self.metrics['queue_depth'] = len(markets)
+        if not markets:
+            return markets
+
+        tp = self.tradepad
+        exchange = tp.exchange
+        detector = FillDetector(exchange)
+        try:
+            grids = dict((market, tp.grids[market]) for market in markets)
+            activity = detector.scan(grids)
+        except Exception:
+            self.failed("Scanning {0} for fills".format(', '.join(markets)))
+            for market in markets:
+                self.requeue(market, False)
+            return list()
+        tp.prune_profit(markets, detector.open_ids)
+
+        outcomes = pool.parallel_map(
+            lambda market: tp.poll_market(market, activity),
+            markets, exchange.workers)
+
+        for o in outcomes:
+            if not o.ok:
+                self.metrics['errors'] += 1
+                logging.debug("Polling %s failed: %s", o.item, o.trace)
+                tp.notify_admin("Polling {0} failed:\n{1}".format(o.item, o.trace))
+            self.requeue(o.item, o.ok and o.result)
+
+        latency = time.time() - start
+        self.metrics['cycles'] += 1
+        self.metrics['cycle_latency'] = latency
+        self.metrics['max_cycle_latency'] = max(
+            self.metrics['max_cycle_latency'], latency)
+        logging.debug("Scheduler %s", self.status())
+        return markets
+
+    def status(self):
+        "Metrics plus each market's current interval and throttle waits."
+        status = dict(self.metrics)
+        status['intervals'] = dict(self.intervals)
+        status['throttle'] = self.tradepad.exchange.limiter.metrics()
+        return status
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.tick()
+            if self.queue:
+                wait = self.queue[0][0] - time.time()
+            else:
+                wait = self.max_interval
+            if self.tradepad.watcher is not None:
+                wait = min(wait, self.tradepad.watcher.interval)
+            if wait > 0:
+                self.stopped.wait(wait)
+
+    def stop(self):
+        self.stopped.set()
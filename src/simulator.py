@@ -0,0 +1,497 @@
+# core
+from collections import defaultdict
+import itertools
+import json
+import logging
+import math
+import random
+import threading
+import time
+
+
+# Failures the matching engine can inject. Message strings are the ones
+# exception.identify_and_raise maps; NETWORK raises IOError instead.
+NETWORK = 'network'
+ERRORS = (
+    'Total must be at least 0.0005.',
+    'Not enough BTC.',
+    'INSUFFICIENT_FUNDS',
+    NETWORK,
+)
+
+
+class SimulatedError(Exception):
+    "An order the simulated exchange refused; the message is the exchange's."
+    pass
+
+
+def split_market(market):
+    "BTC-ETH or BTC_ETH -> ('BTC', 'ETH')."
+    base, coin = market.replace('_', '-').split('-')
+    return base, coin
+
+
+def synthetic_feed(prices, steps=None, volatility=0.005, spread=0.002, seed=None):
+    """Yield {market: {'bid':, 'ask':}} quotes from a random walk.
+
+    prices maps each market to its starting midpoint. The feed is endless
+    unless steps is given.
+    """
+    rng = random.Random(seed)
+    prices = dict(prices)
+    counter = itertools.count() if steps is None else range(steps)
+    for _ in counter:
+        quotes = dict()
+        for market in prices:
+            prices[market] *= math.exp(rng.gauss(0, volatility))
+            mid = prices[market]
+            quotes[market] = dict(
+                bid=mid * (1 - spread / 2), ask=mid * (1 + spread / 2))
+        yield quotes
+
+
+def recorded_feed(path):
+    "Yield quotes from a file with one JSON {market: {'bid':, 'ask':}} per line."
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class MatchingEngine(object):
+    """An in-process exchange: quotes from a feed, our orders matched against them.
+
+    Resting buys fill in full at the ask once it falls to their rate,
+    resting sells at the bid once it rises to theirs. Every client call
+    can be slowed by `latency` seconds and fail with probability
+    `error_rate`; `speed` divides all simulated waiting, so 100 runs a
+    session 100 times faster than the market would.
+    """
+
+    def __init__(self, feed, balances, latency=0.0, error_rate=0.0,
+                 errors=ERRORS, speed=1.0, min_total=0.0005, depth=20,
+                 seed=None):
+        self.feed = iter(feed)
+        self.quotes = dict()
+        self.orders = dict()
+        self.balances = defaultdict(float, balances)
+        self.reserved = defaultdict(float)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.errors = errors
+        self.speed = speed
+        self.min_total = min_total
+        self.depth = depth
+        self.random = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.calls = defaultdict(int)
+        self.lock = threading.RLock()
+        self.step()
+
+    def call(self, name):
+        """Account for one client call: count it, wait, maybe fail.
+
+        Returns an injected error message, or None when the call may proceed.
+        """
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency / self.speed)
+        if self.error_rate and self.random.random() < self.error_rate:
+            error = self.random.choice(self.errors)
+            if error == NETWORK:
+                raise IOError("simulated network failure in {0}".format(name))
+            return error
+        return None
+
+    def step(self):
+        "Advance the feed one tick and match resting orders. False when it ends."
+        try:
+            quotes = next(self.feed)
+        except StopIteration:
+            return False
+
+        self.set_quotes(quotes)
+        return True
+
+    def set_quotes(self, quotes):
+        "Move the given markets to new quotes and match resting orders."
+        with self.lock:
+            self.quotes.update(quotes)
+            for order in list(self.orders.values()):
+                if order['open'] and order['market'] in quotes:
+                    self.match(order)
+
+    def book(self, market, side):
+        "Synthetic depth around the current quote: [(rate, quantity), ...]."
+        quote = self.quotes[market]
+        if side in quote:
+            return [tuple(level) for level in quote[side]]
+
+        size = quote.get('size', 1.0 / quote['ask'])
+        if side == 'sell':
+            return [(quote['ask'] * (1 + 0.001 * i), size)
+                    for i in range(self.depth)]
+        return [(quote['bid'] * (1 - 0.001 * i), size)
+                for i in range(self.depth)]
+
+    def available(self, currency):
+        return self.balances[currency] - self.reserved[currency]
+
+    def place(self, market, side, rate, quantity):
+        "Rest a limit order, filling it at once if it crosses. Returns its id."
+        rate, quantity = float(rate), float(quantity)
+        base, coin = split_market(market)
+        if market not in self.quotes:
+            raise SimulatedError('INVALID_MARKET')
+        if rate * quantity < self.min_total:
+            raise SimulatedError(
+                'Total must be at least {0}.'.format(self.min_total))
+
+        currency, cost = (base, rate * quantity) if side == 'buy' else (coin, quantity)
+        with self.lock:
+            if self.available(currency) < cost:
+                raise SimulatedError('INSUFFICIENT_FUNDS')
+            self.reserved[currency] += cost
+
+            order = dict(
+                id=str(next(self.ids)), market=market, side=side, rate=rate,
+                quantity=quantity, remaining=quantity, open=True,
+                cancelled=False, opened=time.time(), trades=list(),
+            )
+            self.orders[order['id']] = order
+            self.match(order)
+        return order['id']
+
+    def match(self, order):
+        "Fill an order that crosses the quote, at the better of the two prices."
+        quote = self.quotes[order['market']]
+        if order['side'] == 'buy':
+            if quote['ask'] <= order['rate']:
+                self.fill(order, quote['ask'])
+        elif quote['bid'] >= order['rate']:
+            self.fill(order, quote['bid'])
+
+    def fill(self, order, rate):
+        base, coin = split_market(order['market'])
+        quantity, total = order['remaining'], order['remaining'] * rate
+        if order['side'] == 'buy':
+            self.reserved[base] -= quantity * order['rate']
+            self.balances[base] -= total
+            self.balances[coin] += quantity
+        else:
+            self.reserved[coin] -= quantity
+            self.balances[coin] -= quantity
+            self.balances[base] += total
+
+        order['trades'].append(dict(
+            rate=rate, amount=quantity, total=total, date=time.time()))
+        order['remaining'] = 0.0
+        order['open'] = False
+        logging.debug(
+            "Simulated %s %s filled %s @ %s",
+            order['market'], order['side'], quantity, rate)
+
+    def cancel(self, order_id):
+        with self.lock:
+            order = self.orders.get(str(order_id))
+            if order is None or not order['open']:
+                raise SimulatedError('ORDER_NOT_OPEN')
+
+            base, coin = split_market(order['market'])
+            if order['side'] == 'buy':
+                self.reserved[base] -= order['remaining'] * order['rate']
+            else:
+                self.reserved[coin] -= order['remaining']
+            order['open'] = False
+            order['cancelled'] = True
+
+    def open_orders(self):
+        return [o for o in self.orders.values() if o['open']]
+
+    def closed_orders(self):
+        return [o for o in self.orders.values() if not o['open']]
+
+
+def _ok(result):
+    return dict(success=True, message='', result=result)
+
+
+def _failed(message):
+    return dict(success=False, message=message, result=None)
+
+
+class SimulatedBittrex(object):
+    "The subset of the bittrex.Bittrex client BittrexFacade uses, on a MatchingEngine."
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def _order(self, o):
+        return dict(
+            OrderUuid=o['id'], Exchange=o['market'],
+            OrderType='LIMIT_BUY' if o['side'] == 'buy' else 'LIMIT_SELL',
+            Limit=o['rate'], Quantity=o['quantity'],
+            QuantityRemaining=o['remaining'], IsOpen=o['open'],
+            CancelInitiated=o['cancelled'],
+        )
+
+    def _balance(self, currency):
+        e = self.engine
+        return dict(
+            Currency=currency, Balance=e.balances[currency],
+            Available=e.available(currency), Pending=0.0)
+
+    def get_markets(self):
+        error = self.engine.call('get_markets')
+        if error:
+            return _failed(error)
+        return _ok([
+            dict(MarketName=market, BaseCurrency=split_market(market)[0],
+                 MarketCurrency=split_market(market)[1],
+                 MinTradeSize=0.00000001, IsActive=True)
+            for market in self.engine.quotes
+        ])
+
+    def get_market_summaries(self):
+        error = self.engine.call('get_market_summaries')
+        if error:
+            return _failed(error)
+        return _ok([
+            dict(MarketName=market, Bid=q['bid'], Ask=q['ask'],
+                 Last=(q['bid'] + q['ask']) / 2)
+            for market, q in self.engine.quotes.items()
+        ])
+
+    def get_orderbook(self, market, depth_type):
+        error = self.engine.call('get_orderbook')
+        if error:
+            return _failed(error)
+
+        def side(name):
+            return [dict(Rate=rate, Quantity=quantity)
+                    for rate, quantity in self.engine.book(market, name)]
+
+        if depth_type == 'both':
+            return _ok(dict(buy=side('buy'), sell=side('sell')))
+        return _ok(side(depth_type))
+
+    def get_balance(self, currency):
+        error = self.engine.call('get_balance')
+        if error:
+            return _failed(error)
+        return _ok(self._balance(currency))
+
+    def get_balances(self):
+        error = self.engine.call('get_balances')
+        if error:
+            return _failed(error)
+        return _ok([self._balance(c) for c in sorted(self.engine.balances)])
+
+    def _place(self, name, market, side, quantity, rate):
+        error = self.engine.call(name)
+        if error:
+            return _failed(error)
+        try:
+            return _ok(dict(uuid=self.engine.place(market, side, rate, quantity)))
+        except SimulatedError as e:
+            return _failed(str(e))
+
+    def buy_limit(self, market, quantity, rate):
+        return self._place('buy_limit', market, 'buy', quantity, rate)
+
+    def sell_limit(self, market, quantity, rate):
+        return self._place('sell_limit', market, 'sell', quantity, rate)
+
+    def cancel(self, uuid):
+        error = self.engine.call('cancel')
+        if error:
+            return _failed(error)
+        try:
+            self.engine.cancel(uuid)
+        except SimulatedError as e:
+            return _failed(str(e))
+        return _ok(None)
+
+    def get_order(self, uuid):
+        error = self.engine.call('get_order')
+        if error:
+            return _failed(error)
+        order = self.engine.orders.get(str(uuid))
+        if order is None:
+            return _failed('INVALID_ORDER')
+        return _ok(self._order(order))
+
+    def get_open_orders(self, market=None):
+        error = self.engine.call('get_open_orders')
+        if error:
+            return _failed(error)
+        return _ok([
+            self._order(o) for o in self.engine.open_orders()
+            if market is None or o['market'] == market
+        ])
+
+    def get_order_history(self, market=None):
+        error = self.engine.call('get_order_history')
+        if error:
+            return _failed(error)
+        return _ok([
+            self._order(o) for o in self.engine.closed_orders()
+            if market is None or o['market'] == market
+        ])
+
+
+class SimulatedPoloniex(object):
+    "The subset of the poloniex.Poloniex client PoloniexFacade uses, on a MatchingEngine."
+
+    def __init__(self, engine, retval_wrapper=None):
+        self.engine = engine
+        self.wrap = retval_wrapper or (lambda r: r)
+
+    def _call(self, name):
+        error = self.engine.call(name)
+        if error:
+            return self.wrap(dict(error=error))
+
+    def returnTicker(self):
+        return self._call('returnTicker') or self.wrap(dict(
+            (market, dict(lowestAsk=str(q['ask']), highestBid=str(q['bid'])))
+            for market, q in self.engine.quotes.items()
+        ))
+
+    def returnOrderBook(self, market, depth=20):
+        def side(name):
+            return [[str(rate), quantity]
+                    for rate, quantity in self.engine.book(market, name)[:depth]]
+
+        return self._call('returnOrderBook') or self.wrap(dict(
+            asks=side('sell'), bids=side('buy')))
+
+    def returnBalances(self):
+        e = self.engine
+        return self._call('returnBalances') or self.wrap(dict(
+            (c, str(e.available(c))) for c in e.balances))
+
+    def returnCompleteBalances(self):
+        e = self.engine
+        return self._call('returnCompleteBalances') or self.wrap(dict(
+            (c, dict(available=str(e.available(c)),
+                     onOrders=str(e.reserved[c])))
+            for c in e.balances
+        ))
+
+    def returnOpenOrders(self, market='all'):
+        failed = self._call('returnOpenOrders')
+        if failed:
+            return failed
+        orders = defaultdict(list)
+        for o in self.engine.open_orders():
+            orders[o['market']].append(dict(
+                orderNumber=o['id'], type=o['side'], rate=str(o['rate']),
+                amount=str(o['remaining'])))
+        if market != 'all':
+            return orders[market]
+        return self.wrap(dict(orders))
+
+    def _place(self, name, market, side, rate, amount):
+        failed = self._call(name)
+        if failed:
+            return failed
+        try:
+            order_id = self.engine.place(market, side, rate, amount)
+        except SimulatedError as e:
+            return self.wrap(dict(error=str(e)))
+        return self.wrap(dict(orderNumber=order_id, resultingTrades=[]))
+
+    def buy(self, market, rate, amount):
+        return self._place('buy', market, 'buy', rate, amount)
+
+    def sell(self, market, rate, amount):
+        return self._place('sell', market, 'sell', rate, amount)
+
+    def cancelOrder(self, order_number):
+        failed = self._call('cancelOrder')
+        if failed:
+            return failed
+        try:
+            self.engine.cancel(order_number)
+        except SimulatedError as e:
+            return self.wrap(dict(error=str(e)))
+        return self.wrap(dict(success=1))
+
+    def returnOrderTrades(self, order_number):
+        failed = self._call('returnOrderTrades')
+        if failed:
+            return failed
+        order = self.engine.orders.get(str(order_number))
+        if order is None or not order['trades']:
+            return self.wrap(dict(
+                error='Order not found, or you are not the person who placed it.'))
+        return [
+            dict(rate=str(t['rate']), amount=str(t['amount']),
+                 total=str(t['total']))
+            for t in order['trades']
+        ]
+
+
+def engine_from_config(config, feed=None):
+    "Build a MatchingEngine from the [simulator] section of an account config."
+    def option(name, default):
+        if config.has_option('simulator', name):
+            return config.getfloat('simulator', name)
+        return default
+
+    if feed is None and config.has_option('simulator', 'feed'):
+        feed = recorded_feed(config.get('simulator', 'feed'))
+    if feed is None:
+        prices = dict(
+            (pair, option('startPrice', 0.001))
+            for pair in config.get('pairs', 'pairs').split()
+        )
+        feed = synthetic_feed(
+            prices, volatility=option('volatility', 0.005),
+            seed=config.getint('simulator', 'seed')
+            if config.has_option('simulator', 'seed') else None)
+
+    balances = dict(
+        (coin.upper(), float(amount))
+        for coin, amount in config.items('initialcorepositions')
+    )
+    balances['BTC'] = option('btc', 1.0)
+
+    return MatchingEngine(
+        feed, balances,
+        latency=option('latency', 0.0),
+        error_rate=option('errorRate', 0.0),
+        speed=option('speed', 1.0),
+    )
+
+
+class Replay(object):
+    """Run a TradePad against a MatchingEngine, tick by tick.
+
+    Every tick advances the feed and polls the TradePad. `interval` is the
+    simulated seconds between ticks; the engine's speed divides it.
+    """
+
+    def __init__(self, tradepad, engine, interval=60.0):
+        self.tradepad = tradepad
+        self.engine = engine
+        self.interval = interval
+
+    def start(self):
+        "Build and place fresh grids, as main_init does."
+        self.tradepad.exchange.cancelAllOpen()
+        self.tradepad.build_new_grids()
+        self.tradepad.issue_trades()
+
+    def run(self, ticks=None):
+        "Poll until the feed ends or `ticks` have passed. Returns ticks run."
+        ran = 0
+        while ticks is None or ran < ticks:
+            if not self.engine.step():
+                break
+            self.tradepad.poll()
+            ran += 1
+            if self.interval:
+                time.sleep(self.interval / self.engine.speed)
+        return ran
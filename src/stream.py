@@ -0,0 +1,225 @@
+# core
+import json
+import logging
+import threading
+import time
+import traceback
+
+# local
+import orderbook
+
+
+class LocalBook(object):
+    """One market's order book, kept current from sequence-numbered diffs.
+
+    A diff carries absolute quantities per price level (0 removes the
+    level), so applying one twice is harmless; what matters is not
+    missing any. A gap in sequence numbers marks the book out of sync
+    until it is reloaded from a REST snapshot.
+    """
+
+    def __init__(self, market):
+        self.market = market
+        self.seq = None
+        self.bids = dict()
+        self.asks = dict()
+        self.updated = 0
+
+    @property
+    def synced(self):
+        return self.seq is not None
+
+    def load(self, response, seq):
+        "Replace the book with a REST order book response."
+        self.bids = dict(orderbook.levels(response, 'buy'))
+        self.asks = dict(orderbook.levels(response, 'sell'))
+        self.seq = seq
+        self.updated = time.time()
+
+    def apply(self, message):
+        for side, levels in (('bids', self.bids), ('asks', self.asks)):
+            for rate, quantity in message.get(side, ()):
+                rate, quantity = float(rate), float(quantity)
+                if quantity:
+                    levels[rate] = quantity
+                else:
+                    levels.pop(rate, None)
+        self.seq = message['seq']
+        self.updated = time.time()
+
+    def quote(self):
+        "(best bid, best ask), or None while either side is empty."
+        if not self.bids or not self.asks:
+            return None
+        return max(self.bids), min(self.asks)
+
+    def sell_orders(self):
+        "The ask side as returnSellOrderBook returns it, best rate first."
+        return [
+            dict(Rate=rate, Quantity=self.asks[rate])
+            for rate in sorted(self.asks)
+        ]
+
+
+class MarketDataStream(object):
+    """Local tickers and order books for the configured pairs, fed by a stream.
+
+    Messages are {"market":, "seq":, "bids": [[rate, qty], ...], "asks": ...}.
+    A market whose sequence jumps is resynchronised from the exchange's
+    REST order book, and the message that revealed the gap is applied on
+    top. Books not updated within max_age seconds are reported as absent,
+    so the facade falls back to REST.
+
+    Books are only changed on the stream thread, under `lock`; readers on
+    trading threads take it too and get copies. When the source fails or
+    ends and `connect` is given, every book is marked out of sync and
+    connect() is called for a new source, waiting `backoff` seconds
+    first, doubled on each failure in a row up to max_backoff.
+    """
+
+    def __init__(self, exchange, markets, source, max_age=30.0, connect=None,
+                 backoff=1.0, max_backoff=60.0):
+        self.exchange = exchange
+        self.books = dict((market, LocalBook(market)) for market in markets)
+        self.source = source
+        self.max_age = max_age
+        self.connect = connect
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stats = dict(messages=0, resyncs=0, ignored=0, reconnects=0)
+
+    def handle(self, message):
+        book = self.books.get(message.get('market'))
+        if book is None:
+            self.stats['ignored'] += 1
+            return
+
+        self.stats['messages'] += 1
+        if book.synced and message['seq'] <= book.seq:
+            self.stats['ignored'] += 1
+            return
+        # The REST snapshot is fetched before taking the lock, so readers
+        # are not held up by the request.
+        snapshot = None
+        if not book.synced or message['seq'] != book.seq + 1:
+            snapshot = self.resync(book, message['seq'] - 1)
+
+        with self.lock:
+            if snapshot is not None:
+                book.load(snapshot, message['seq'] - 1)
+            book.apply(message)
+
+    def resync(self, book, seq):
+        logging.debug(
+            "Resyncing %s order book at sequence %s (had %s)",
+            book.market, seq, book.seq)
+        self.stats['resyncs'] += 1
+        return self.exchange.returnOrderBook(book.market)
+
+    def desync(self):
+        "Mark every book out of sync, so it is reloaded before being used again."
+        with self.lock:
+            for book in self.books.values():
+                book.seq = None
+
+    def fresh(self, market):
+        "The market's book if it is synced and recent; call with lock held."
+        book = self.books.get(market)
+        if book is None or not book.synced:
+            return None
+        if time.time() - book.updated > self.max_age:
+            return None
+        return book
+
+    def quote(self, market):
+        with self.lock:
+            book = self.fresh(market)
+            return book and book.quote()
+
+    def sell_orders(self, market):
+        with self.lock:
+            book = self.fresh(market)
+            return book and book.sell_orders()
+
+    def run(self):
+        delay = self.backoff
+        while True:
+            try:
+                for message in self.source:
+                    self.handle(message)
+                    delay = self.backoff
+                logging.debug("Market data stream ended")
+            except Exception:
+                logging.debug(
+                    "Market data stream failed: %s", traceback.format_exc())
+            if self.connect is None:
+                return
+
+            self.desync()
+            logging.debug("Reconnecting market data stream in %ss", delay)
+            time.sleep(delay)
+            delay = min(self.max_backoff, delay * 2)
+            self.stats['reconnects'] += 1
+            self.source = self.connect()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='market-data')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+
+def websocket_source(url):
+    "Yield decoded JSON messages from a websocket. Needs websocket-client."
+    import websocket
+
+    ws = websocket.create_connection(url)
+    try:
+        while True:
+            yield json.loads(ws.recv())
+    finally:
+        ws.close()
+
+
+def replay_source(path, speed=None):
+    """Yield messages recorded one JSON object per line, standing in for the socket.
+
+    With speed, the gaps between recorded "time" stamps are replayed that
+    many times faster; without it, messages come as fast as they are read.
+    """
+    last = None
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            stamp = message.get('time')
+            if speed and stamp is not None and last is not None:
+                time.sleep(max(0, stamp - last) / speed)
+            last = stamp
+            yield message
+
+
+def from_config(exchange, config, markets=None):
+    """Start a MarketDataStream for markets, by default the configured pairs,
+    if [stream] names a source."""
+    connect = None
+    if config.has_option('stream', 'url'):
+        url = config.get('stream', 'url')
+        connect = lambda: websocket_source(url)
+        source = connect()
+    elif config.has_option('stream', 'replay'):
+        source = replay_source(config.get('stream', 'replay'))
+    else:
+        return None
+
+    max_age = 30.0
+    if config.has_option('stream', 'maxAge'):
+        max_age = config.getfloat('stream', 'maxAge')
+
+    if markets is None:
+        markets = config.get('pairs', 'pairs').split()
+    return MarketDataStream(
+        exchange, markets, source, max_age, connect=connect).start()
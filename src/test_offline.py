@@ -0,0 +1,311 @@
+# Checks that run against the local stand-ins, with no exchange account,
+# mail server or network: python -m pytest test_offline.py
+
+# core
+import asyncore
+import ConfigParser
+import io
+import json
+import smtpd
+import threading
+import time
+
+# local
+from benchmark import LAZY_MODULES, STARTUP_MAX_MS, startup_time
+import exchange
+from grid import BuyGrid, SellGrid
+import main
+from mymailer import Notifier, SMTPConnection
+from mynumbers import _div_round, _parse, F
+from persist import Persist, PROFIT
+import simulator
+import stream
+
+
+class RecordedBooks(object):
+    "Answers returnOrderBook with one bid and one ask, counting the calls."
+
+    def __init__(self):
+        self.calls = 0
+
+    def returnOrderBook(self, market):
+        self.calls += 1
+        return dict(
+            buy=[dict(Rate=0.0009, Quantity=5.0)],
+            sell=[dict(Rate=0.0011, Quantity=5.0)])
+
+
+def test_stream_resyncs_after_a_gap(tmpdir):
+    path = tmpdir.join('stream.jsonl')
+    path.write('\n'.join(json.dumps(message) for message in [
+        dict(market='BTC-X0', seq=1, asks=[[0.00105, 1.0]]),
+        dict(market='BTC-X0', seq=2, bids=[[0.00095, 2.0]]),
+        dict(market='BTC-X0', seq=2, asks=[[0.00101, 9.0]]),
+        dict(market='BTC-X0', seq=5, asks=[[0.00105, 0]]),
+        dict(market='BTC-X0', seq=6, asks=[[0.00104, 3.0]]),
+    ]))
+    exchange = RecordedBooks()
+    market_data = stream.MarketDataStream(
+        exchange, ['BTC-X0'], stream.replay_source(str(path)), max_age=60)
+    market_data.run()
+
+    # Once to load the book at the first message, once at the 2 -> 5 gap.
+    assert exchange.calls == 2
+    assert market_data.stats['resyncs'] == 2
+    assert market_data.stats['ignored'] == 1
+    assert market_data.quote('BTC-X0') == (0.0009, 0.00104)
+    assert [level['Rate'] for level in market_data.sell_orders('BTC-X0')] == [
+        0.00104, 0.0011]
+
+
+class Outbox(smtpd.SMTPServer):
+    "A local SMTP server that keeps the messages it receives."
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = list()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append(data)
+
+
+def test_notifier_sends_duplicates_as_one_digest():
+    outbox = Outbox()
+    loop = threading.Thread(target=asyncore.loop, kwargs=dict(timeout=0.05))
+    loop.daemon = True
+    loop.start()
+    try:
+        notifier = Notifier(
+            SMTPConnection('127.0.0.1', outbox.port),
+            'trader@localhost', ['admin@localhost'], window=60).start()
+        for _ in range(3):
+            notifier.notify('joseph', 'Polling BTC-X0 failed')
+        notifier.notify('peter', 'Polling BTC-X1 failed')
+        notifier.stop()
+
+        deadline = time.time() + 5
+        while not outbox.messages and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        outbox.close()
+
+    assert notifier.sent == 1
+    assert len(outbox.messages) == 1
+    digest = outbox.messages[0]
+    assert '(joseph, peter) ADSactly Grid Trader Errors' in digest
+    assert '[joseph] x3' in digest
+    assert '[peter] x1' in digest
+    assert digest.count('Polling BTC-X0 failed') == 1
+
+
+def test_importing_main_defers_heavy_modules():
+    wall, loaded = startup_time(repeat=3)
+    assert loaded == [], "imported eagerly: {0} (lazy: {1})".format(
+        ' '.join(loaded), ' '.join(LAZY_MODULES))
+    assert wall * 1000 <= STARTUP_MAX_MS, "import main took {0:.1f} ms".format(
+        wall * 1000)
+
+
+def test_fixed_hashes_like_the_numbers_it_equals():
+    assert F(1) == 1 and hash(F(1)) == hash(1)
+    assert F('0.5') == 0.5 and hash(F('0.5')) == hash(0.5)
+    assert {1: 'one', 0.5: 'half'}[F(1)] == 'one'
+    assert {F('0.5'): 'half'}[0.5] == 'half'
+    assert len(set([F(2), 2, 2.0, F('2.00000000')])) == 1
+
+
+def test_parse_rounds_half_to_even_at_the_eighth_place():
+    assert _parse('0.000000015') == 2
+    assert _parse('0.000000025') == 2
+    assert _parse('0.0000000250001') == 3
+    assert _parse('0.000000024999') == 2
+    assert _parse('-0.000000015') == -2
+    assert _parse('1.5e-8') == 2
+    assert _parse('12') == 1200000000
+
+
+def test_div_round_rounds_half_to_even():
+    assert [_div_round(n, 2) for n in (1, 3, 5, -1, -3)] == [0, 2, 2, 0, -2]
+    assert _div_round(7, 3) == 2
+    assert _div_round(8, 3) == 3
+    assert _div_round(5, -2) == -2
+    assert F(1) / 3 == F('0.33333333')
+    assert F('0.00000001') * F('0.5') == 0
+
+
+def sell_grid(price, pair='BTC-X0'):
+    grid = SellGrid(pair=pair, current_market_price=price, majorLevel=1,
+                    increments=1, numberOfOrders=3, size=10)
+    grid.ids = ['s1', 's2', 's3']
+    return grid
+
+
+def buy_grid(price, pair='BTC-X0'):
+    grid = BuyGrid(pair=pair, current_market_price=price, majorLevel=1,
+                   increments=1, numberOfOrders=3, size=10, profitTarget=6)
+    grid.ids = ['b1', 'b2', 'b3']
+    return grid
+
+
+def test_persist_replays_the_journal_over_the_snapshot(tmpdir):
+    path = str(tmpdir.join('state', 'bittrex.storage'))
+    persist = Persist(path)
+    persist.snapshot({'BTC-X0': {'sell': sell_grid(0.001).to_state()}})
+
+    moved = sell_grid(0.002)
+    moved.ids[0] = 's4'
+    persist.record('BTC-X0', 'sell', moved)
+    persist.record('BTC-X0', 'buy', buy_grid(0.001))
+    persist.record('BTC-X1', 'sell', sell_grid(0.01, 'BTC-X1'))
+    persist.record('BTC-X1', 'sell', None)
+    persist.record('BTC-X0', PROFIT, ['p1', 'p2'])
+
+    state = Persist(path).load()
+    assert sorted(state) == ['BTC-X0']
+    assert state['BTC-X0']['sell'] == moved.to_state()
+    assert state['BTC-X0']['buy']['trade_ids'] == ['b1', 'b2', 'b3']
+    assert state['BTC-X0'][PROFIT] == ['p1', 'p2']
+
+
+def test_persist_snapshots_fold_in_the_journal(tmpdir):
+    path = str(tmpdir.join('bittrex.storage'))
+    persist = Persist(path, snapshot_every=3)
+    for price in (0.001, 0.002, 0.003):
+        persist.record('BTC-X0', 'sell', sell_grid(price))
+
+    assert persist.generation == 1
+    assert tmpdir.join('bittrex.storage.journal').read() == ''
+    assert Persist(path).load() == {
+        'BTC-X0': {'sell': sell_grid(0.003).to_state()}}
+
+
+def test_persist_ignores_a_journal_older_than_the_snapshot(tmpdir):
+    path = str(tmpdir.join('bittrex.storage'))
+    persist = Persist(path)
+    persist.record('BTC-X0', 'sell', sell_grid(0.001))
+    old_journal = tmpdir.join('bittrex.storage.journal').read()
+    assert json.loads(old_journal)['generation'] == 0
+
+    # A crash after the new snapshot is renamed into place, before the
+    # journal is emptied, leaves the old lines behind.
+    persist.snapshot({'BTC-X0': {'sell': sell_grid(0.002).to_state()}})
+    tmpdir.join('bittrex.storage.journal').write(old_journal)
+
+    reopened = Persist(path)
+    assert reopened.generation == 1
+    assert reopened.load() == {
+        'BTC-X0': {'sell': sell_grid(0.002).to_state()}}
+
+    reopened.record('BTC-X0', 'buy', buy_grid(0.002))
+    assert sorted(Persist(path).load()['BTC-X0']) == ['buy', 'sell']
+
+
+def test_persist_repairs_a_torn_journal_line(tmpdir):
+    path = str(tmpdir.join('bittrex.storage'))
+    Persist(path).record('BTC-X0', 'sell', sell_grid(0.001))
+    journal = tmpdir.join('bittrex.storage.journal')
+    journal.write('{"market":"BTC-X0","side":"bu', mode='a')
+
+    persist = Persist(path)
+    assert persist.journaled == 1
+    persist.record('BTC-X0', 'buy', buy_grid(0.001))
+
+    assert len(journal.read().splitlines()) == 2
+    assert sorted(Persist(path).load()['BTC-X0']) == ['buy', 'sell']
+
+
+ACCOUNT = u"""
+[pairs]
+pairs: {pairs}
+
+[initialcorepositions]
+{positions}
+
+[sellgrid]
+majorLevel: 1
+numberOfOrders: 3
+size: 30
+increments: 1
+
+[buygrid]
+profitTarget: 6
+majorLevel: 1
+numberOfOrders: 3
+size: 30
+increments: 1
+"""
+
+
+def simulated_account(engine, pairs=('BTC-X0',)):
+    config = ConfigParser.RawConfigParser()
+    config.readfp(io.StringIO(ACCOUNT.format(
+        pairs=' '.join(pairs),
+        positions='\n'.join(
+            u'{0}: 10000'.format(pair.split('-')[1]) for pair in pairs))))
+    tp = main.TradePad(config)
+    tp.exchange = exchange.BittrexFacade(
+        api=simulator.SimulatedBittrex(engine))
+    return tp
+
+
+def test_reconcile_adopts_open_orders_and_repairs_the_rest(tmpdir):
+    engine = simulator.MatchingEngine([], dict(X0=10000, BTC=10.0))
+    engine.set_quotes({'BTC-X0': dict(bid=0.001, ask=0.00101)})
+    path = str(tmpdir.join('bittrex.storage'))
+    cold = simulated_account(engine)
+    main.main_init(cold.exchange, cold, path)
+    sells, buys = cold.grids['BTC-X0']['sell'], cold.grids['BTC-X0']['buy']
+
+    # While the service was down: one buy was cancelled by hand, an order
+    # no grid knows about was placed, and one sell's id was lost from the
+    # state, though the order itself is still open.
+    engine.cancel(buys.trade_id(1))
+    stray = engine.place('BTC-X0', 'buy', 0.0005, 10)
+    state = Persist(path).load()
+    state['BTC-X0']['sell']['trade_ids'][0] = 'lost'
+
+    warm = simulated_account(engine)
+    calls = sum(engine.calls.values())
+    counts = warm.reconcile(state)
+
+    assert counts == dict(adopted=5, cancelled=1, replaced=1, built=0)
+    g = warm.grids['BTC-X0']
+    assert g['sell'].trade_ids == sells.trade_ids
+    assert g['buy'].trade_id(0) == buys.trade_id(0)
+    assert g['buy'].trade_id(2) == buys.trade_id(2)
+    replaced = g['buy'].trade_id(1)
+    assert replaced != buys.trade_id(1)
+    assert engine.orders[replaced]['open']
+    assert engine.orders[stray]['cancelled']
+    # Open and cancelled orders, market rules, balances, one cancel and
+    # one order placed.
+    assert sum(engine.calls.values()) - calls <= 6
+
+
+def test_warm_restart_costs_a_few_requests_however_many_markets():
+    pairs = ['BTC-X{0}'.format(i) for i in range(20)]
+    balances = dict((pair.split('-')[1], 10000) for pair in pairs)
+    balances['BTC'] = 1000.0
+    engine = simulator.MatchingEngine([], balances)
+    engine.set_quotes(dict(
+        (pair, dict(bid=0.001, ask=0.00101)) for pair in pairs))
+
+    cold = simulated_account(engine, pairs)
+    calls = sum(engine.calls.values())
+    cold.exchange.cancelAllOpen()
+    cold.build_new_grids()
+    cold.issue_trades()
+    cold_calls = sum(engine.calls.values()) - calls
+    state = dict(
+        (market, dict((side, g.to_state()) for side, g in sides.items()))
+        for market, sides in cold.grids.items())
+
+    warm = simulated_account(engine, pairs)
+    calls = sum(engine.calls.values())
+    counts = warm.reconcile(state)
+    warm_calls = sum(engine.calls.values()) - calls
+
+    assert counts == dict(adopted=120, cancelled=0, replaced=0, built=0)
+    assert warm_calls <= 2
+    assert cold_calls >= 200
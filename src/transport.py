@@ -0,0 +1,139 @@
+# core
+import logging
+import threading
+from urlparse import urlparse
+
+# 3rd party
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# local
+import metrics
+
+
+class Transport(object):
+    """Keep-alive HTTP sessions, one per exchange host.
+
+    Each host gets a requests.Session whose connection pool holds up to
+    pool_size sockets, so repeated calls skip TCP and TLS setup. Every
+    request gets the configured timeout. Only connection errors are
+    retried here, since the request never reached the exchange: Bittrex
+    places and cancels orders over GET, so resending after a read timeout
+    or a gateway error could place an order twice. Callers that know a
+    request is safe to repeat, like cancelOrders, retry it themselves.
+    """
+
+    def __init__(self, pool_size=10, timeout=10.0, retries=3, backoff=0.3):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.sessions = dict()
+        self.lock = threading.Lock()
+
+    def session(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.sessions:
+                logging.debug("Opening a keep-alive session to %s", host)
+                self.sessions[host] = self.new_session()
+            return self.sessions[host]
+
+    def new_session(self):
+        retry = Retry(
+            total=self.retries, connect=self.retries, read=0, status=0,
+            backoff_factor=self.backoff)
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs['timeout'] = self.timeout
+        response = self.session(url).request(method, url, **kwargs)
+        if metrics.enabled:
+            metrics.registry.received(urlparse(url).netloc, len(response.content))
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+class RequestsShim(object):
+    """Stands in for the requests module inside an exchange client.
+
+    get() and post() go through the Transport; anything else (Session,
+    auth, exceptions) is the real requests module's.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def get(self, url, **kwargs):
+        return self.transport.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.transport.post(url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+def install(transport, client_module):
+    """Route a client module's module-level requests calls through transport.
+
+    The exchange clients call requests.get/post directly (or import get and
+    post by name), which opens a new connection every time. Whatever name
+    the module holds them under is rebound.
+
+    The client module is shared by every account on that exchange, so the
+    last Transport installed serves all of them; connect_accounts in main
+    refuses accounts whose [transport] settings differ.
+    """
+    shim = RequestsShim(transport)
+    for name, value in list(vars(client_module).items()):
+        if value is requests or isinstance(value, RequestsShim):
+            setattr(client_module, name, shim)
+        elif value is requests.get:
+            setattr(client_module, name, shim.get)
+        elif value is requests.post:
+            setattr(client_module, name, shim.post)
+
+
+_shared = dict()
+_shared_lock = threading.Lock()
+
+
+def settings(config):
+    "The (poolSize, timeout, retries) of the [transport] section."
+    def option(name, default, get):
+        if config.has_option('transport', name):
+            return get('transport', name)
+        return default
+
+    return (
+        option('poolSize', 10, config.getint),
+        option('timeout', 10.0, config.getfloat),
+        option('retries', 3, config.getint),
+    )
+
+
+def from_config(config):
+    "The Transport for the [transport] section; equal settings share one."
+    key = settings(config)
+    with _shared_lock:
+        if key not in _shared:
+            _shared[key] = Transport(*key)
+        return _shared[key]